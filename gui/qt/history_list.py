@@ -60,8 +60,8 @@ class HistoryList(MyTreeWidget):
         self.update_headers(headers)
 
     def get_domain(self):
-        '''Replaced in address_dialog.py'''
-        return self.wallet.get_addresses()
+        '''Replaced in address_dialog.py.  None is the whole wallet.'''
+        return None
 
     def on_update(self):
         self.wallet = self.parent.wallet
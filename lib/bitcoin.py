@@ -35,6 +35,7 @@ from util import print_error, InvalidPassword
 
 import ecdsa
 import aes
+import ecc
 
 ################################## transactions
 
@@ -134,6 +135,18 @@ def var_int(i):
         return "ff"+int_to_hex(i,8)
 
 
+def var_int_size(i):
+    '''Size in bytes of var_int(i).'''
+    if i<0xfd:
+        return 1
+    elif i<=0xffff:
+        return 3
+    elif i<=0xffffffff:
+        return 5
+    else:
+        return 9
+
+
 def op_push(i):
     if i<0x4c:
         return int_to_hex(i)
@@ -145,6 +158,18 @@ def op_push(i):
         return '4e' + int_to_hex(i,4)
 
 
+def op_push_size(i):
+    '''Size in bytes of op_push(i).'''
+    if i<0x4c:
+        return 1
+    elif i<0xff:
+        return 2
+    elif i<0xffff:
+        return 3
+    else:
+        return 5
+
+
 def sha256(x):
     return hashlib.sha256(x).digest()
 
@@ -221,15 +246,36 @@ def public_key_to_bc_address(public_key):
     h160 = hash_160(public_key)
     return hash_160_to_bc_address(h160)
 
+
+# Memo of address <-> hash160 conversions, which are done for every
+# input and output of every transaction the wallet looks at.  The
+# dicts are emptied when they reach ADDRESS_CACHE_SIZE entries.
+ADDRESS_CACHE_SIZE = 20000
+_address_of_h160 = {}
+_h160_of_address = {}
+
+def _memo_put(cache, key, value):
+    if len(cache) >= ADDRESS_CACHE_SIZE:
+        cache.clear()
+    cache[key] = value
+
 def hash_160_to_bc_address(h160, addrtype = 0):
     vh160 = chr(addrtype) + h160
-    h = Hash(vh160)
-    addr = vh160 + h[0:4]
-    return base_encode(addr, base=58)
+    addr = _address_of_h160.get(vh160)
+    if addr is None:
+        h = Hash(vh160)
+        addr = base_encode(vh160 + h[0:4], base=58)
+        _memo_put(_address_of_h160, vh160, addr)
+        _memo_put(_h160_of_address, addr, (addrtype, h160))
+    return addr
 
 def bc_address_to_hash_160(addr):
-    bytes = base_decode(addr, 25, base=58)
-    return ord(bytes[0]), bytes[1:21]
+    r = _h160_of_address.get(addr)
+    if r is None:
+        bytes = base_decode(addr, 25, base=58)
+        r = ord(bytes[0]), bytes[1:21]
+        _memo_put(_h160_of_address, addr, r)
+    return r
 
 
 __b58chars = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
@@ -238,6 +284,18 @@ assert len(__b58chars) == 58
 __b43chars = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ$*+-./:'
 assert len(__b43chars) == 43
 
+# Big integers are converted 10 digits at a time: divmod by base**10
+# is done on longs, the digits of each chunk with machine-size ints,
+# two digits per step.
+__pairs = {
+    58: [a + b for a in __b58chars for b in __b58chars],
+    43: [a + b for a in __b43chars for b in __b43chars],
+}
+__index = {
+    58: dict((c, i) for i, c in enumerate(__b58chars)),
+    43: dict((c, i) for i, c in enumerate(__b43chars)),
+}
+
 
 def base_encode(v, base):
     """ encode v, which is a string of bytes, to base58."""
@@ -245,21 +303,22 @@ def base_encode(v, base):
         chars = __b58chars
     elif base == 43:
         chars = __b43chars
-    long_value = 0L
-    for (i, c) in enumerate(v[::-1]):
-        long_value += (256**i) * ord(c)
-    result = ''
-    while long_value >= base:
-        div, mod = divmod(long_value, base)
-        result = chars[mod] + result
-        long_value = div
-    result = chars[long_value] + result
+    pairs = __pairs[base]
+    big = base ** 10
+    base2 = base * base
+    long_value = int(v.encode('hex'), 16) if v else 0
+    digits = []
+    while long_value:
+        long_value, chunk = divmod(long_value, big)
+        chunk = int(chunk)
+        for i in xrange(5):
+            chunk, mod = divmod(chunk, base2)
+            digits.append(pairs[mod])
+    digits.reverse()
+    result = ''.join(digits).lstrip(chars[0]) or chars[0]
     # Bitcoin does a little leading-zero-compression:
     # leading 0-bytes in the input become leading-1s
-    nPad = 0
-    for c in v:
-        if c == '\0': nPad += 1
-        else: break
+    nPad = len(v) - len(v.lstrip('\0'))
     return (chars[0]*nPad) + result
 
 
@@ -269,19 +328,21 @@ def base_decode(v, length, base):
         chars = __b58chars
     elif base == 43:
         chars = __b43chars
-    long_value = 0L
-    for (i, c) in enumerate(v[::-1]):
-        long_value += chars.find(c) * (base**i)
-    result = ''
-    while long_value >= 256:
-        div, mod = divmod(long_value, 256)
-        result = chr(mod) + result
-        long_value = div
-    result = chr(long_value) + result
-    nPad = 0
-    for c in v:
-        if c == chars[0]: nPad += 1
-        else: break
+    index = __index[base]
+    big = base ** 10
+    long_value = 0
+    try:
+        for i in xrange(0, len(v), 10):
+            group = v[i:i+10]
+            chunk = 0
+            for c in group:
+                chunk = chunk * base + index[c]
+            long_value = long_value * (big if len(group) == 10 else base ** len(group)) + chunk
+    except KeyError:
+        raise ValueError('invalid base%d string' % base)
+    h = '%x' % long_value
+    result = (h if len(h) % 2 == 0 else '0' + h).decode('hex')
+    nPad = len(v) - len(v.lstrip(chars[0]))
     result = chr(0)*nPad + result
     if length is not None and len(result) != length:
         return None
@@ -294,7 +355,10 @@ def EncodeBase58Check(vchIn):
 
 
 def DecodeBase58Check(psz):
-    vchRet = base_decode(psz, None, base=58)
+    try:
+        vchRet = base_decode(psz, None, base=58)
+    except ValueError:
+        return None
     key = vchRet[0:-4]
     csum = vchRet[-4:]
     hash = Hash(key)
@@ -412,15 +476,15 @@ def msg_magic(message):
 
 def verify_message(address, sig, message):
     try:
-        public_key, compressed = pubkey_from_signature(sig, message)
+        pubkey, compressed = pubkey_from_signature(sig, message)
         # check public key using the address
-        pubkey = point_to_ser(public_key.pubkey.point, compressed)
         addr = public_key_to_bc_address(pubkey)
         if address != addr:
             raise Exception("Bad signature")
         # check message
         h = Hash(msg_magic(message))
-        public_key.verify_digest(sig[1:], h, sigdecode = ecdsa.util.sigdecode_string)
+        if not get_ec_backend().verify(h, sig[1:], pubkey):
+            raise Exception("Bad signature")
         return True
     except Exception as e:
         print_error("Verification error: {0}".format(e))
@@ -490,15 +554,19 @@ class MyVerifyingKey(ecdsa.VerifyingKey):
         alpha = ( x * x * x  + curveFp.a() * x + curveFp.b() ) % curveFp.p()
         beta = msqr.modular_sqrt(alpha, curveFp.p())
         y = beta if (beta - recid) % 2 == 0 else curveFp.p() - beta
-        # 1.4 the constructor checks that nR is at infinity
-        R = Point(curveFp, x, y, order)
+        # 1.4 the cofactor is 1, so nR is at infinity if R is on the curve
+        R = x, y
+        if not ecc.is_on_curve(R):
+            raise Exception("Bad signature")
         # 1.5 compute e from message:
         e = string_to_number(h)
         minus_e = -e % order
         # 1.6 compute Q = r^-1 (sR - eG)
         inv_r = numbertheory.inverse_mod(r,order)
-        Q = inv_r * ( s * R + minus_e * G )
-        return klass.from_public_point( Q, curve )
+        Q = ecc.mul_mul_add(inv_r * minus_e, inv_r * s, R)
+        if Q is None:
+            raise Exception("Bad signature")
+        return klass.from_public_point( Point(curveFp, Q[0], Q[1], order), curve )
 
 
 def pubkey_from_signature(sig, message):
@@ -514,7 +582,10 @@ def pubkey_from_signature(sig, message):
         compressed = False
     recid = nV - 27
     h = Hash(msg_magic(message))
-    return MyVerifyingKey.from_signature(sig[1:], recid, h, curve = SECP256k1), compressed
+    pubkey = get_ec_backend().recover(h, sig[1:], recid, compressed)
+    if pubkey is None:
+        raise Exception("Bad signature")
+    return pubkey, compressed
 
 
 class MySigningKey(ecdsa.SigningKey):
@@ -530,11 +601,204 @@ class MySigningKey(ecdsa.SigningKey):
         return r, s
 
 
+# EC backends.  They all take and return byte strings: 32-byte secrets
+# and hashes, serialized public keys and 64-byte (r, s) signatures.
+# Signatures are deterministic (RFC 6979) with a low s value, so every
+# backend produces the same bytes.
+
+class PythonECBackend(object):
+
+    name = 'python'
+
+    def __init__(self):
+        # the last parsed public key; BIP32 derives many children of
+        # the same parent key
+        self.parsed = None, None
+
+    def parse_pubkey(self, pubkey):
+        last, point = self.parsed
+        if pubkey != last:
+            point = ecc.deser(pubkey)
+            self.parsed = pubkey, point
+        return point
+
+    def pubkey_from_secret(self, secret, compressed=True):
+        k = string_to_number(secret)
+        if not 0 < k < ecc.N:
+            raise Exception('invalid secret exponent')
+        return ecc.ser(ecc.generator_mul(k), compressed)
+
+    def sign(self, msg_hash, secret):
+        r, s = ecc.sign(string_to_number(secret), string_to_number(msg_hash))
+        return number_to_string(r, ecc.N) + number_to_string(s, ecc.N)
+
+    def verify(self, msg_hash, sig, pubkey):
+        try:
+            point = self.parse_pubkey(pubkey)
+        except ValueError:
+            return False
+        r, s = string_to_number(sig[0:32]), string_to_number(sig[32:64])
+        return ecc.verify(point, string_to_number(msg_hash), r, s)
+
+    def recover(self, msg_hash, sig, recid, compressed=True):
+        r, s = string_to_number(sig[0:32]), string_to_number(sig[32:64])
+        point = ecc.recover(string_to_number(msg_hash), r, s, recid)
+        return ecc.ser(point, compressed) if point else None
+
+    def tweak_add(self, pubkey, tweak, compressed=True):
+        '''Return the serialization of tweak*G + pubkey.'''
+        t = string_to_number(tweak)
+        point = ecc.mul_add(t, self.parse_pubkey(pubkey)) if t < ecc.N else None
+        if point is None:
+            raise Exception('invalid tweak')
+        return ecc.ser(point, compressed)
+
+
+class LibsecpECBackend(object):
+    '''libsecp256k1 loaded with ctypes.'''
+
+    name = 'libsecp256k1'
+    lib_names = ['libsecp256k1.so.0', 'libsecp256k1.so', 'libsecp256k1.dylib',
+                 'libsecp256k1.dll', 'libsecp256k1-0.dll']
+
+    CONTEXT_SIGN_VERIFY = (1 << 0) | (1 << 8) | (1 << 9)
+    EC_COMPRESSED = (1 << 1) | (1 << 8)
+    EC_UNCOMPRESSED = (1 << 1)
+
+    def __init__(self):
+        import ctypes, ctypes.util
+        names = self.lib_names
+        path = ctypes.util.find_library('secp256k1')
+        if path:
+            names = [path] + names
+        for name in names:
+            try:
+                lib = ctypes.cdll.LoadLibrary(name)
+                break
+            except OSError:
+                continue
+        else:
+            raise ImportError('libsecp256k1 not found')
+        p, i, s = ctypes.c_char_p, ctypes.c_int, ctypes.c_size_t
+        v = ctypes.c_void_p
+        lib.secp256k1_context_create.argtypes = [ctypes.c_uint]
+        lib.secp256k1_context_create.restype = v
+        for name, args in [
+                ('secp256k1_ec_pubkey_parse', [v, p, p, s]),
+                ('secp256k1_ec_pubkey_serialize', [v, p, ctypes.POINTER(s), p, ctypes.c_uint]),
+                ('secp256k1_ec_pubkey_create', [v, p, p]),
+                ('secp256k1_ec_pubkey_tweak_add', [v, p, p]),
+                ('secp256k1_ecdsa_sign', [v, p, p, p, v, v]),
+                ('secp256k1_ecdsa_verify', [v, p, p, p]),
+                ('secp256k1_ecdsa_signature_parse_compact', [v, p, p]),
+                ('secp256k1_ecdsa_signature_serialize_compact', [v, p, p]),
+                ('secp256k1_ecdsa_signature_normalize', [v, p, p])]:
+            f = getattr(lib, name)
+            f.argtypes = args
+            f.restype = i
+        # the recovery module is optional
+        if hasattr(lib, 'secp256k1_ecdsa_recover'):
+            lib.secp256k1_ecdsa_recoverable_signature_parse_compact.argtypes = [v, p, p, i]
+            lib.secp256k1_ecdsa_recoverable_signature_parse_compact.restype = i
+            lib.secp256k1_ecdsa_recover.argtypes = [v, p, p, p]
+            lib.secp256k1_ecdsa_recover.restype = i
+        else:
+            self.recover = PythonECBackend().recover
+        self.ctypes = ctypes
+        self.lib = lib
+        self.ctx = lib.secp256k1_context_create(self.CONTEXT_SIGN_VERIFY)
+
+    def _parse(self, pubkey):
+        buf = self.ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ec_pubkey_parse(self.ctx, buf, pubkey, len(pubkey)):
+            raise Exception('invalid public key')
+        return buf
+
+    def _serialize(self, buf, compressed):
+        size = 33 if compressed else 65
+        out = self.ctypes.create_string_buffer(size)
+        outlen = self.ctypes.c_size_t(size)
+        flags = self.EC_COMPRESSED if compressed else self.EC_UNCOMPRESSED
+        self.lib.secp256k1_ec_pubkey_serialize(self.ctx, out, self.ctypes.byref(outlen), buf, flags)
+        return out.raw[:outlen.value]
+
+    def pubkey_from_secret(self, secret, compressed=True):
+        buf = self.ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ec_pubkey_create(self.ctx, buf, secret):
+            raise Exception('invalid secret exponent')
+        return self._serialize(buf, compressed)
+
+    def sign(self, msg_hash, secret):
+        sig = self.ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ecdsa_sign(self.ctx, sig, msg_hash, secret, None, None):
+            raise Exception('signing failed')
+        out = self.ctypes.create_string_buffer(64)
+        self.lib.secp256k1_ecdsa_signature_serialize_compact(self.ctx, out, sig)
+        return out.raw
+
+    def verify(self, msg_hash, sig, pubkey):
+        buf = self.ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ec_pubkey_parse(self.ctx, buf, pubkey, len(pubkey)):
+            return False
+        s = self.ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ecdsa_signature_parse_compact(self.ctx, s, sig):
+            return False
+        # python-ecdsa accepts high s values too
+        self.lib.secp256k1_ecdsa_signature_normalize(self.ctx, s, s)
+        return self.lib.secp256k1_ecdsa_verify(self.ctx, s, msg_hash, buf) == 1
+
+    def recover(self, msg_hash, sig, recid, compressed=True):
+        s = self.ctypes.create_string_buffer(65)
+        if not self.lib.secp256k1_ecdsa_recoverable_signature_parse_compact(self.ctx, s, sig, recid):
+            return None
+        buf = self.ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ecdsa_recover(self.ctx, buf, s, msg_hash):
+            return None
+        return self._serialize(buf, compressed)
+
+    def tweak_add(self, pubkey, tweak, compressed=True):
+        buf = self._parse(pubkey)
+        if not self.lib.secp256k1_ec_pubkey_tweak_add(self.ctx, buf, tweak):
+            raise Exception('invalid tweak')
+        return self._serialize(buf, compressed)
+
+
+ec_backends = [LibsecpECBackend, PythonECBackend]
+ec_backend = None
+
+def set_ec_backend(name='auto'):
+    '''Select the EC backend by name; 'auto' picks the first one that
+    can be loaded.  Return the name of the selected backend.'''
+    global ec_backend
+    names = [klass.name for klass in ec_backends]
+    if name != 'auto' and name not in names:
+        raise BaseException('Unknown EC backend: %s' % name)
+    for klass in ec_backends:
+        if name not in ['auto', klass.name]:
+            continue
+        try:
+            ec_backend = klass()
+            break
+        except Exception as e:
+            print_error('cannot load EC backend', klass.name, e)
+    else:
+        # fall back to pure python
+        ec_backend = PythonECBackend()
+    return ec_backend.name
+
+def get_ec_backend():
+    if ec_backend is None:
+        set_ec_backend()
+    return ec_backend
+
+
 class EC_KEY(object):
 
     def __init__( self, k ):
         secret = string_to_number(k)
-        self.pubkey = ecdsa.ecdsa.Public_key( generator_secp256k1, generator_secp256k1 * secret )
+        x, y = ecc.generator_mul(secret)
+        point = Point(curve_secp256k1, x, y, generator_secp256k1.order())
+        self.pubkey = ecdsa.ecdsa.Public_key( generator_secp256k1, point )
         self.privkey = ecdsa.ecdsa.Private_key( self.pubkey, secret )
         self.secret = secret
 
@@ -542,10 +806,9 @@ class EC_KEY(object):
         return point_to_ser(self.pubkey.point, compressed).encode('hex')
 
     def sign(self, msg_hash):
-        private_key = MySigningKey.from_secret_exponent(self.secret, curve = SECP256k1)
-        public_key = private_key.get_verifying_key()
-        signature = private_key.sign_digest_deterministic(msg_hash, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_string)
-        assert public_key.verify_digest(signature, msg_hash, sigdecode = ecdsa.util.sigdecode_string)
+        backend = get_ec_backend()
+        signature = backend.sign(msg_hash, number_to_string(self.secret, ecc.N))
+        assert backend.verify(msg_hash, signature, self.get_public_key().decode('hex'))
         return signature
 
     def sign_message(self, message, is_compressed):
@@ -562,13 +825,14 @@ class EC_KEY(object):
 
 
     def verify_message(self, sig, message):
-        public_key, compressed = pubkey_from_signature(sig, message)
+        pubkey, compressed = pubkey_from_signature(sig, message)
         # check public key
-        if point_to_ser(public_key.pubkey.point, compressed) != point_to_ser(self.pubkey.point, compressed):
+        if pubkey != point_to_ser(self.pubkey.point, compressed):
             raise Exception("Bad signature")
         # check message
         h = Hash(msg_magic(message))
-        public_key.verify_digest(sig[1:], h, sigdecode = ecdsa.util.sigdecode_string)
+        if not get_ec_backend().verify(h, sig[1:], pubkey):
+            raise Exception("Bad signature")
 
 
     # ECIES encryption/decryption methods; AES-128-CBC with PKCS7 is used as the cipher; hmac-sha256 is used as the mac
@@ -582,7 +846,7 @@ class EC_KEY(object):
 
         ephemeral_exponent = number_to_string(ecdsa.util.randrange(pow(2,256)), generator_secp256k1.order())
         ephemeral = EC_KEY(ephemeral_exponent)
-        ecdh_key = point_to_ser(pk * ephemeral.privkey.secret_multiplier)
+        ecdh_key = ecc.ser(ecc.point_mul(ephemeral.privkey.secret_multiplier, (pk.x(), pk.y())))
         key = hashlib.sha512(ecdh_key).digest()
         iv, key_e, key_m = key[0:16], key[16:32], key[32:]
         ciphertext = aes_encrypt_with_iv(key_e, iv, message)
@@ -616,7 +880,7 @@ class EC_KEY(object):
         if not ecdsa.ecdsa.point_is_valid(generator_secp256k1, ephemeral_pubkey.x(), ephemeral_pubkey.y()):
             raise Exception('invalid ciphertext: invalid ephemeral pubkey')
 
-        ecdh_key = point_to_ser(ephemeral_pubkey * self.privkey.secret_multiplier)
+        ecdh_key = ecc.ser(ecc.point_mul(self.privkey.secret_multiplier, (ephemeral_pubkey.x(), ephemeral_pubkey.y())))
         key = hashlib.sha512(ecdh_key).digest()
         iv, key_e, key_m = key[0:16], key[16:32], key[32:]
         if mac != hmac.new(key_m, encrypted[:-32], hashlib.sha256).digest():
@@ -633,10 +897,8 @@ BIP32_PRIME = 0x80000000
 
 def get_pubkeys_from_secret(secret):
     # public key
-    private_key = ecdsa.SigningKey.from_string( secret, curve = SECP256k1 )
-    public_key = private_key.get_verifying_key()
-    K = public_key.to_string()
-    K_compressed = GetPubKey(public_key.pubkey,True)
+    K = get_ec_backend().pubkey_from_secret(secret, False)[1:]
+    K_compressed = chr(2 + (ord(K[-1]) & 1)) + K[0:32]
     return K, K_compressed
 
 
@@ -654,8 +916,7 @@ def CKD_priv(k, c, n):
 
 def _CKD_priv(k, c, s, is_prime):
     order = generator_secp256k1.order()
-    keypair = EC_KEY(k)
-    cK = GetPubKey(keypair.pubkey,True)
+    cK = get_ec_backend().pubkey_from_secret(k, True)
     data = chr(0) + k + s if is_prime else cK + s
     I = hmac.new(c, data, hashlib.sha512).digest()
     k_n = number_to_string( (string_to_number(I[0:32]) + string_to_number(k)) % order , order )
@@ -676,13 +937,21 @@ def CKD_pub(cK, c, n):
 def _CKD_pub(cK, c, s):
     order = generator_secp256k1.order()
     I = hmac.new(c, cK + s, hashlib.sha512).digest()
-    curve = SECP256k1
-    pubkey_point = string_to_number(I[0:32])*curve.generator + ser_to_point(cK)
-    public_key = ecdsa.VerifyingKey.from_public_point( pubkey_point, curve = SECP256k1 )
+    cK_n = get_ec_backend().tweak_add(cK, I[0:32])
     c_n = I[32:]
-    cK_n = GetPubKey(public_key.pubkey,True)
     return cK_n, c_n
 
+def CKD_pub_range(cK, c, start, count):
+    '''Return the compressed public keys of children start to
+    start+count-1.'''
+    backend = get_ec_backend()
+    out = []
+    for n in xrange(start, start + count):
+        if n & BIP32_PRIME: raise
+        I = hmac.new(c, cK + rev_hex(int_to_hex(n,4)).decode('hex'), hashlib.sha512).digest()
+        out.append(backend.tweak_add(cK, I[0:32]))
+    return out
+
 
 BITCOIN_HEADER_PRIV = "0488ade4"
 BITCOIN_HEADER_PUB = "0488b21e"
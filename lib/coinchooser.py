@@ -180,7 +180,7 @@ class CoinChooserBase(PrintError):
         # Copy the ouputs so when adding change we don't modify "outputs"
         tx = Transaction.from_io([], outputs[:])
         # Size of the transaction with no inputs and no change
-        base_size = tx.estimated_size()
+        base_size = Transaction.estimated_tx_size([], outputs)
         spent_amount = tx.output_value()
 
         def sufficient_funds(buckets):
@@ -245,7 +245,9 @@ class Commands:
     def deserialize(self, tx):
         """Deserialize a serialized transaction"""
         tx = Transaction(tx)
-        return tx.deserialize()
+        d = tx.deserialize()
+        d['inputs'] = [txin.to_dict() for txin in d['inputs']]
+        return d
 
     @command('n')
     def broadcast(self, tx, timeout=30):
@@ -277,7 +279,8 @@ class Commands:
         if is_address(address):
             return self.wallet.get_private_key(address, self._password)
         domain = json_loads(address)
-        return [self.wallet.get_private_key(address, self._password) for address in domain]
+        with self.wallet.unlocked(self._password):
+            return [self.wallet.get_private_key(address, self._password) for address in domain]
 
     @command('w')
     def ismine(self, address):
@@ -341,9 +344,14 @@ class Commands:
         return self.network.get_servers()
 
     @command('')
-    def version(self):
+    def version(self, details=False):
         """Return the version of electrum."""
         import electrum  # Needs to stay here to prevent ciruclar imports
+        if details:
+            return {
+                'version': electrum.ELECTRUM_VERSION,
+                'ec_backend': bitcoin.get_ec_backend().name,
+            }
         return electrum.ELECTRUM_VERSION
 
     @command('w')
@@ -685,6 +693,7 @@ command_options = {
     'pending':     (None, "--pending",     "Show only pending requests."),
     'expired':     (None, "--expired",     "Show only expired requests."),
     'paid':        (None, "--paid",        "Show only paid requests."),
+    'details':     (None, "--details",     "Also show the EC backend in use (set with the ec_backend config variable)"),
 }
 
 
@@ -34,6 +34,7 @@ from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer, SimpleJSONRPCReq
 from network import Network
 from util import json_decode, DaemonThread
 from util import print_msg, print_error, print_stderr
+from bitcoin import get_ec_backend
 from wallet import WalletStorage, Wallet
 from commands import known_commands, Commands
 from simple_config import SimpleConfig
@@ -156,6 +157,7 @@ class Daemon(DaemonThread):
                     'nodes': self.network.get_interfaces(),
                     'connected': self.network.is_connected(),
                     'auto_connect': p[4],
+                    'ec_backend': get_ec_backend().name,
                     'wallets': {k: w.is_up_to_date()
                                 for k, w in self.wallets.items()},
                 }
@@ -184,7 +186,7 @@ class Daemon(DaemonThread):
         if path in self.wallets:
             wallet = self.wallets[path]
             return wallet
-        storage = WalletStorage(path)
+        storage = WalletStorage(path, use_journal=self.config.get('wallet_journal', False))
         if not storage.file_exists:
             return
         if storage.requires_split() or storage.requires_upgrade() or storage.get_action():
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2016 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Pure python arithmetic and ECDSA on secp256k1.
+#
+# Affine points are (x, y) tuples and the point at infinity is None.
+# Intermediate results are kept in Jacobian coordinates (X, Y, Z), with
+# x = X/Z^2 and y = Y/Z^3, so that a single field inversion is needed
+# per multiplication.  Multiples of the generator are looked up in a
+# precomputed table of j * 16^i * G, which turns k*G into at most 64
+# point additions and no doublings.
+
+import hashlib
+import hmac
+import threading
+
+P = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEFFFFFC2F
+N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+B = 7
+G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+     0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8)
+
+WINDOW = 4
+
+
+def inverse(a):
+    return pow(a, P - 2, P)
+
+
+def is_on_curve(point):
+    x, y = point
+    return 0 <= x < P and 0 <= y < P and (y * y - x * x * x - B) % P == 0
+
+
+def y_from_x(x, odd):
+    y = pow((x * x * x + B) % P, (P + 1) / 4, P)
+    if (y * y - x * x * x - B) % P:
+        raise ValueError('x is not on the curve')
+    return P - y if bool(y & 1) != bool(odd) else y
+
+
+def to_jacobian(point):
+    return None if point is None else (point[0], point[1], 1)
+
+
+def to_affine(jp):
+    if jp is None:
+        return None
+    X, Y, Z = jp
+    zi = inverse(Z)
+    zi2 = zi * zi % P
+    return X * zi2 % P, Y * zi2 * zi % P
+
+
+def batch_to_affine(jps):
+    '''Convert a list of Jacobian points (none at infinity) with a
+    single inversion.'''
+    acc = 1
+    prods = []
+    for X, Y, Z in jps:
+        prods.append(acc)
+        acc = acc * Z % P
+    inv = inverse(acc)
+    out = [None] * len(jps)
+    for i in xrange(len(jps) - 1, -1, -1):
+        X, Y, Z = jps[i]
+        zi = inv * prods[i] % P
+        inv = inv * Z % P
+        zi2 = zi * zi % P
+        out[i] = X * zi2 % P, Y * zi2 * zi % P
+    return out
+
+
+def jacobian_double(jp):
+    if jp is None:
+        return None
+    X, Y, Z = jp
+    if Y == 0:
+        return None
+    YY = Y * Y % P
+    S = 4 * X * YY % P
+    M = 3 * X * X % P
+    X3 = (M * M - 2 * S) % P
+    Y3 = (M * (S - X3) - 8 * YY * YY) % P
+    Z3 = 2 * Y * Z % P
+    return X3, Y3, Z3
+
+
+def jacobian_add_affine(jp, point):
+    '''Add an affine point to a Jacobian point.'''
+    if point is None:
+        return jp
+    if jp is None:
+        return point[0], point[1], 1
+    X1, Y1, Z1 = jp
+    x2, y2 = point
+    ZZ = Z1 * Z1 % P
+    H = (x2 * ZZ - X1) % P
+    R = (y2 * ZZ * Z1 - Y1) % P
+    if H == 0:
+        return jacobian_double(jp) if R == 0 else None
+    HH = H * H % P
+    HHH = H * HH % P
+    V = X1 * HH % P
+    X3 = (R * R - HHH - 2 * V) % P
+    Y3 = (R * (V - X3) - Y1 * HHH) % P
+    Z3 = Z1 * H % P
+    return X3, Y3, Z3
+
+
+def jacobian_add(jp1, jp2):
+    if jp1 is None:
+        return jp2
+    if jp2 is None:
+        return jp1
+    X1, Y1, Z1 = jp1
+    X2, Y2, Z2 = jp2
+    Z1Z1 = Z1 * Z1 % P
+    Z2Z2 = Z2 * Z2 % P
+    U1 = X1 * Z2Z2 % P
+    U2 = X2 * Z1Z1 % P
+    S1 = Y1 * Z2Z2 * Z2 % P
+    S2 = Y2 * Z1Z1 * Z1 % P
+    H = (U2 - U1) % P
+    R = (S2 - S1) % P
+    if H == 0:
+        return jacobian_double(jp1) if R == 0 else None
+    HH = H * H % P
+    HHH = H * HH % P
+    V = U1 * HH % P
+    X3 = (R * R - HHH - 2 * V) % P
+    Y3 = (R * (V - X3) - S1 * HHH) % P
+    Z3 = Z1 * Z2 * H % P
+    return X3, Y3, Z3
+
+
+def window_table(point):
+    '''Affine multiples 1*point .. 15*point.'''
+    jps = [to_jacobian(point)]
+    for j in xrange(2, 1 << WINDOW):
+        jps.append(jacobian_add_affine(jps[-1], point))
+    return batch_to_affine(jps)
+
+
+_g_table = None
+_g_table_lock = threading.Lock()
+
+def generator_table():
+    '''Row i holds j * 16^i * G for j = 1 .. 15.'''
+    global _g_table
+    if _g_table is None:
+        with _g_table_lock:
+            if _g_table is None:
+                table = []
+                base = G
+                for i in xrange(256 / WINDOW):
+                    row = window_table(base)
+                    table.append(row)
+                    # 16 * base = 15 * base + base
+                    base = to_affine(jacobian_add_affine(to_jacobian(row[-1]), base))
+                _g_table = table
+    return _g_table
+
+
+def generator_mul_jacobian(k):
+    table = generator_table()
+    k %= N
+    acc = None
+    i = 0
+    while k:
+        d = k & 15
+        if d:
+            acc = jacobian_add_affine(acc, table[i][d - 1])
+        k >>= WINDOW
+        i += 1
+    return acc
+
+
+def generator_mul(k):
+    '''Return k*G as an affine point.'''
+    return to_affine(generator_mul_jacobian(k))
+
+
+def point_mul(k, point):
+    '''Return k*point, using a fixed window of 4 bits.'''
+    k %= N
+    if k == 0 or point is None:
+        return None
+    table = window_table(point)
+    digits = []
+    while k:
+        digits.append(k & 15)
+        k >>= WINDOW
+    acc = None
+    for d in reversed(digits):
+        for i in xrange(WINDOW):
+            acc = jacobian_double(acc)
+        if d:
+            acc = jacobian_add_affine(acc, table[d - 1])
+    return to_affine(acc)
+
+
+def mul_add(k, point):
+    '''Return k*G + point.'''
+    return to_affine(jacobian_add_affine(generator_mul_jacobian(k), point))
+
+
+def mul_mul_add(u1, u2, point):
+    '''Return u1*G + u2*point.'''
+    return to_affine(jacobian_add_affine(generator_mul_jacobian(u1), point_mul(u2, point)))
+
+
+def inverse_mod_n(a):
+    return pow(a, N - 2, N)
+
+
+def deterministic_k(secret, e):
+    '''Nonce of RFC 6979 with HMAC-SHA256.'''
+    x = '%064x' % secret
+    h = '%064x' % (e % N)
+    data = (x + h).decode('hex')
+    V = '\x01' * 32
+    K = '\x00' * 32
+    K = hmac.new(K, V + '\x00' + data, hashlib.sha256).digest()
+    V = hmac.new(K, V, hashlib.sha256).digest()
+    K = hmac.new(K, V + '\x01' + data, hashlib.sha256).digest()
+    V = hmac.new(K, V, hashlib.sha256).digest()
+    while True:
+        V = hmac.new(K, V, hashlib.sha256).digest()
+        k = int(V.encode('hex'), 16)
+        if 0 < k < N:
+            return k
+        K = hmac.new(K, V + '\x00', hashlib.sha256).digest()
+        V = hmac.new(K, V, hashlib.sha256).digest()
+
+
+def sign(secret, e):
+    '''Deterministic ECDSA signature (r, s) of the 256-bit hash e,
+    with a low s value.'''
+    k = deterministic_k(secret, e)
+    r = generator_mul(k)[0] % N
+    s = inverse_mod_n(k) * (e + secret * r) % N
+    if r == 0 or s == 0:
+        raise ValueError('bad nonce')
+    return r, min(s, N - s)
+
+
+def verify(point, e, r, s):
+    if not (0 < r < N and 0 < s < N):
+        return False
+    w = inverse_mod_n(s)
+    R = mul_mul_add(e * w, r * w, point)
+    return R is not None and R[0] % N == r
+
+
+def recover(e, r, s, recid):
+    '''Public key of the signature (r, s) of e, or None.'''
+    if not (0 < r < N and 0 < s < N):
+        return None
+    x = r + (recid / 2) * N
+    if x >= P:
+        return None
+    try:
+        R = x, y_from_x(x, recid & 1)
+    except ValueError:
+        return None
+    # Q = r^-1 (sR - eG)
+    inv_r = inverse_mod_n(r)
+    return mul_mul_add(-e * inv_r, s * inv_r, R)
+
+
+def ser(point, compressed=True):
+    x, y = point
+    if compressed:
+        return ('%02x%064x' % (2 + (y & 1), x)).decode('hex')
+    return ('04%064x%064x' % (x, y)).decode('hex')
+
+
+def deser(s):
+    '''Parse a serialized public key; raise ValueError if it is not
+    a point of the curve.'''
+    if len(s) == 33 and s[0] in '\x02\x03':
+        x = int(s[1:].encode('hex'), 16)
+        if x >= P:
+            raise ValueError('invalid public key')
+        return x, y_from_x(x, s[0] == '\x03')
+    if len(s) == 65 and s[0] == '\x04':
+        point = int(s[1:33].encode('hex'), 16), int(s[33:].encode('hex'), 16)
+        if not is_on_curve(point):
+            raise ValueError('invalid public key')
+        return point
+    raise ValueError('invalid public key encoding')
@@ -25,6 +25,7 @@
 # SOFTWARE.
 
 
+import threading
 from unicodedata import normalize
 
 from version import *
@@ -53,15 +54,107 @@ class KeyStore(PrintError):
         return False
 
 
+class UnlockedKeys(object):
+    '''The decrypted secret of a software keystore, and the private keys
+    derived from it, kept for the duration of a with block:
+
+        with keystore.unlocked(password) as keys:
+            sec = keys.get_private_key(sequence)
+
+    The password is checked once, when the outermost block is entered.
+    Blocks can be nested, and the keys are dropped when the outermost
+    one exits.'''
+
+    def __init__(self, keystore, password):
+        self.keystore = keystore
+        self.password = password
+        self.depth = 0
+        self.secret = None
+        # keystore specific, e.g. derived branch keys
+        self.cache = {}
+        # sequence -> private key
+        self.keys = {}
+
+    def __enter__(self):
+        with self.keystore.unlock_lock:
+            if self.depth == 0:
+                self.secret = self.keystore.decrypt(self.password)
+            self.depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self.keystore.unlock_lock:
+            self.depth -= 1
+            if self.depth == 0:
+                self.secret = None
+                self.cache.clear()
+                self.keys.clear()
+                if self.keystore.unlocked_keys is self:
+                    self.keystore.unlocked_keys = None
+
+    def get_private_key(self, sequence):
+        sequence = tuple(sequence)
+        pk = self.keys.get(sequence)
+        if pk is None:
+            assert self.depth > 0
+            pk = self.keystore.derive_private_key(sequence, self)
+            self.keys[sequence] = pk
+        return pk
+
+
+class UnlockedKeyStores(object):
+    '''Unlock several keystores in a single with block.'''
+
+    def __init__(self, keystores, password):
+        self.unlocked = [k.unlocked(password) for k in keystores
+                         if isinstance(k, Software_KeyStore) and not k.is_watching_only()]
+
+    def __enter__(self):
+        entered = []
+        try:
+            for keys in self.unlocked:
+                keys.__enter__()
+                entered.append(keys)
+        except BaseException:
+            for keys in reversed(entered):
+                keys.__exit__(None, None, None)
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        for keys in reversed(self.unlocked):
+            keys.__exit__(*exc)
+
+
 class Software_KeyStore(KeyStore):
 
     def __init__(self):
         KeyStore.__init__(self)
         self.use_encryption = False
+        self.unlocked_keys = None
+        self.unlock_lock = threading.Lock()
 
     def has_password(self):
         return self.use_encryption
 
+    def unlocked(self, password):
+        '''Return an UnlockedKeys context for this keystore.  If one is
+        already open with the same password, it is shared.'''
+        with self.unlock_lock:
+            keys = self.unlocked_keys
+            if keys is None or keys.password != password:
+                keys = self.unlocked_keys = UnlockedKeys(self, password)
+        return keys
+
+    def decrypt(self, password):
+        '''Check the password, and return what derive_private_key()
+        needs, as keys.secret.'''
+        return None
+
+    def get_private_key(self, sequence, password):
+        with self.unlocked(password) as keys:
+            return keys.get_private_key(sequence)
+
     def sign_message(self, sequence, message, password):
         sec = self.get_private_key(sequence, password)
         key = regenerate_key(sec)
@@ -129,11 +222,11 @@ class Imported_KeyStore(Software_KeyStore):
         pubkey = (self.change_pubkeys if for_change else self.receiving_pubkeys)[i]
         return pubkey
 
-    def get_private_key(self, sequence, password):
+    def derive_private_key(self, sequence, keys):
         for_change, i = sequence
         assert for_change == 0
         pubkey = (self.change_pubkeys if for_change else self.receiving_pubkeys)[i]
-        pk = pw_decode(self.keypairs[pubkey], password)
+        pk = pw_decode(self.keypairs[pubkey], keys.password)
         # this checks the password
         if pubkey != public_key_from_private_key(pk):
             raise InvalidPassword()
@@ -190,27 +283,36 @@ class Xpub:
 
     def __init__(self):
         self.xpub = None
-        self.xpub_receive = None
-        self.xpub_change = None
+        # for_change -> (c, cK) of the branch
+        self.branches = {}
 
     def add_master_public_key(self, xpub):
         self.xpub = xpub
+        self.branches = {}
 
     def get_master_public_key(self):
         return self.xpub
 
-    def derive_pubkey(self, for_change, n):
-        xpub = self.xpub_change if for_change else self.xpub_receive
-        if xpub is None:
+    def get_branch(self, for_change):
+        branch = self.branches.get(for_change)
+        if branch is None:
             xpub = bip32_public_derivation(self.xpub, "", "/%d"%for_change)
-            if for_change:
-                self.xpub_change = xpub
-            else:
-                self.xpub_receive = xpub
+            _, _, _, c, cK = deserialize_xkey(xpub)
+            branch = self.branches[for_change] = c, cK
+        return branch
+
+    def derive_pubkeys(self, for_change, start, count):
+        c, cK = self.get_branch(for_change)
+        return [x.encode('hex') for x in CKD_pub_range(cK, c, start, count)]
+
+    def derive_pubkey(self, for_change, n):
+        return self.derive_pubkeys(for_change, n, 1)[0]
+
+    @classmethod
+    def derive_pubkey_from_xpub(self, xpub, for_change, n):
         _, _, _, c, cK = deserialize_xkey(xpub)
-        cK, c = CKD_pub(cK, c, n)
-        result = cK.encode('hex')
-        return result
+        cK, c = CKD_pub(cK, c, for_change)
+        return CKD_pub_range(cK, c, n, 1)[0].encode('hex')
 
     def get_xpubkey(self, c, i):
         s = ''.join(map(lambda x: bitcoin.int_to_hex(x,2), (c, i)))
@@ -264,9 +366,14 @@ class BIP32_KeyStore(Deterministic_KeyStore, Xpub):
         return pw_decode(self.xprv, password)
 
     def check_password(self, password):
+        self.decrypt(password)
+
+    def decrypt(self, password):
         xprv = pw_decode(self.xprv, password)
-        if deserialize_xkey(xprv)[3] != deserialize_xkey(self.xpub)[3]:
+        _, _, _, c, k = deserialize_xkey(xprv)
+        if c != deserialize_xkey(self.xpub)[3]:
             raise InvalidPassword()
+        return k, c
 
     def update_password(self, old_password, new_password):
         if old_password is not None:
@@ -285,6 +392,10 @@ class BIP32_KeyStore(Deterministic_KeyStore, Xpub):
         return self.xprv is None
 
     def get_keypairs_for_sig(self, tx, password):
+        with self.unlocked(password) as keys:
+            return self._get_keypairs_for_sig(tx, keys)
+
+    def _get_keypairs_for_sig(self, tx, keys):
         keypairs = {}
         for txin in tx.inputs():
             num_sig = txin.get('num_sig')
@@ -300,7 +411,7 @@ class BIP32_KeyStore(Deterministic_KeyStore, Xpub):
                     # this pubkey already signed
                     continue
                 derivation = txin['derivation']
-                sec = self.get_private_key(derivation, password)
+                sec = keys.get_private_key(derivation)
                 if sec:
                     keypairs[x_pubkey] = sec
 
@@ -308,9 +419,9 @@ class BIP32_KeyStore(Deterministic_KeyStore, Xpub):
 
     def sign_transaction(self, tx, password):
         # Raise if password is not correct.
-        self.check_password(password)
-        # Add private keys
-        keypairs = self.get_keypairs_for_sig(tx, password)
+        with self.unlocked(password):
+            # Add private keys
+            keypairs = self.get_keypairs_for_sig(tx, password)
         # Sign
         if keypairs:
             tx.sign(keypairs)
@@ -331,11 +442,17 @@ class BIP32_KeyStore(Deterministic_KeyStore, Xpub):
     def can_sign(self, xpub):
         return xpub == self.xpub and self.xprv is not None
 
-    def get_private_key(self, sequence, password):
-        xprv = self.get_master_private_key(password)
-        _, _, _, c, k = deserialize_xkey(xprv)
-        pk = bip32_private_key(sequence, k, c)
-        return pk
+    def derive_private_key(self, sequence, keys):
+        # the branch keys are shared by the inputs of a transaction
+        branch = sequence[:-1]
+        node = keys.cache.get(branch)
+        if node is None:
+            k, c = keys.secret
+            for i in branch:
+                k, c = CKD_priv(k, c, i)
+            node = keys.cache[branch] = k, c
+        k, c = CKD_priv(node[0], node[1], sequence[-1])
+        return SecretToASecret(k, True)
 
 
 class Old_KeyStore(Deterministic_KeyStore):
@@ -384,8 +501,8 @@ class Old_KeyStore(Deterministic_KeyStore):
     @classmethod
     def mpk_from_seed(klass, seed):
         secexp = klass.stretch_key(seed)
-        master_private_key = ecdsa.SigningKey.from_secret_exponent(secexp, curve = SECP256k1)
-        master_public_key = master_private_key.get_verifying_key().to_string()
+        secret = number_to_string(secexp % generator_secp256k1.order(), generator_secp256k1.order())
+        master_public_key = get_ec_backend().pubkey_from_secret(secret, False)[1:]
         return master_public_key
 
     @classmethod
@@ -407,14 +524,16 @@ class Old_KeyStore(Deterministic_KeyStore):
     @classmethod
     def get_pubkey_from_mpk(self, mpk, for_change, n):
         z = self.get_sequence(mpk, for_change, n)
-        master_public_key = ecdsa.VerifyingKey.from_string(mpk, curve = SECP256k1)
-        pubkey_point = master_public_key.pubkey.point + z*SECP256k1.generator
-        public_key2 = ecdsa.VerifyingKey.from_public_point(pubkey_point, curve = SECP256k1)
-        return '04' + public_key2.to_string().encode('hex')
+        order = generator_secp256k1.order()
+        pubkey = get_ec_backend().tweak_add('\x04' + mpk, number_to_string(z % order, order), False)
+        return pubkey.encode('hex')
 
     def derive_pubkey(self, for_change, n):
         return self.get_pubkey_from_mpk(self.mpk, for_change, n)
 
+    def derive_pubkeys(self, for_change, start, count):
+        return [self.derive_pubkey(for_change, n) for n in xrange(start, start + count)]
+
     def get_private_key_from_stretched_exponent(self, for_change, n, secexp):
         order = generator_secp256k1.order()
         secexp = (secexp + self.get_sequence(self.mpk, for_change, n)) % order
@@ -422,18 +541,21 @@ class Old_KeyStore(Deterministic_KeyStore):
         compressed = False
         return SecretToASecret(pk, compressed)
 
-    def get_private_key(self, sequence, password):
-        seed = self.get_seed(password)
-        self.check_seed(seed)
+    def decrypt(self, password):
+        secexp = self.stretch_key(self.get_seed(password))
+        self.check_stretched_key(secexp)
+        return secexp
+
+    def derive_private_key(self, sequence, keys):
         for_change, n = sequence
-        secexp = self.stretch_key(seed)
-        pk = self.get_private_key_from_stretched_exponent(for_change, n, secexp)
-        return pk
+        return self.get_private_key_from_stretched_exponent(for_change, n, keys.secret)
 
     def check_seed(self, seed):
-        secexp = self.stretch_key(seed)
-        master_private_key = ecdsa.SigningKey.from_secret_exponent( secexp, curve = SECP256k1 )
-        master_public_key = master_private_key.get_verifying_key().to_string()
+        self.check_stretched_key(self.stretch_key(seed))
+
+    def check_stretched_key(self, secexp):
+        secret = number_to_string(secexp % generator_secp256k1.order(), generator_secp256k1.order())
+        master_public_key = get_ec_backend().pubkey_from_secret(secret, False)[1:]
         if master_public_key != self.mpk:
             print_error('invalid password (mpk)', self.mpk.encode('hex'), master_public_key.encode('hex'))
             raise InvalidPassword()
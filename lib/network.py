@@ -66,6 +66,9 @@ DEFAULT_SERVERS = {
 
 NODES_RETRY_INTERVAL = 60
 SERVER_RETRY_INTERVAL = 10
+# The network loop is woken up by socket activity and by other
+# threads; this is how long it waits when nothing happens.
+SELECT_TIMEOUT = 1.0
 
 
 def parse_servers(result):
@@ -117,6 +120,19 @@ from simple_config import SimpleConfig
 
 proxy_modes = ['socks4', 'socks5', 'http']
 
+class SocketQueue(Queue.Queue):
+    '''Queue of the sockets of connection attempts, that wakes up the
+    network loop when one is put.'''
+
+    def __init__(self, wakeup):
+        Queue.Queue.__init__(self)
+        self.wakeup = wakeup
+
+    def put(self, item, *args):
+        Queue.Queue.put(self, item, *args)
+        self.wakeup.set()
+
+
 def serialize_proxy(p):
     if type(p) != dict:
         return None
@@ -221,7 +237,9 @@ class Network(util.DaemonThread):
         self.interfaces = {}
         self.auto_connect = self.config.get('auto_connect', True)
         self.connecting = set()
-        self.socket_queue = Queue.Queue()
+        # wakes up the network thread from other threads
+        self.wakeup = util.Wakeup()
+        self.socket_queue = SocketQueue(self.wakeup)
         self.start_network(deserialize_server(self.default_server)[2],
                            deserialize_proxy(self.config.get('proxy')))
 
@@ -438,7 +456,7 @@ class Network(util.DaemonThread):
         assert not self.interfaces
         self.connecting = set()
         # Get a new queue - no old pending connections thanks!
-        self.socket_queue = Queue.Queue()
+        self.socket_queue = SocketQueue(self.wakeup)
 
     def set_parameters(self, host, port, protocol, proxy, auto_connect):
         proxy_str = serialize_proxy(proxy)
@@ -606,6 +624,7 @@ class Network(util.DaemonThread):
         '''Messages is a list of (method, params) tuples'''
         with self.lock:
             self.pending_sends.append((messages, callback))
+        self.wakeup.set()
 
     def process_pending_sends(self):
         # Requests needs connectivity.  If we don't have an interface,
@@ -793,24 +812,25 @@ class Network(util.DaemonThread):
             break
 
     def wait_on_sockets(self):
-        # Python docs say Windows doesn't like empty selects.
-        # Sleep to prevent busy looping
-        if not self.interfaces:
-            time.sleep(0.1)
-            return
-        rin = [i for i in self.interfaces.values()]
+        '''Wait until a socket is ready, another thread wakes us up,
+        or SELECT_TIMEOUT.  Requests are written as soon as their
+        socket is writable, responses dispatched as they arrive.'''
+        rin = [self.wakeup] + self.interfaces.values()
         win = [i for i in self.interfaces.values() if i.unsent_requests]
         try:
-            rout, wout, xout = select.select(rin, win, [], 0.1)
+            rout, wout, xout = select.select(rin, win, [], SELECT_TIMEOUT)
         except socket.error as (code, msg):
             if code == errno.EINTR:
                 return
             raise
         assert not xout
+        # what woke us up is handled below or by the caller
+        self.wakeup.clear()
         for interface in wout:
             interface.send_requests()
         for interface in rout:
-            self.process_responses(interface)
+            if interface is not self.wakeup:
+                self.process_responses(interface)
 
     def run(self):
         self.blockchain.init()
@@ -822,8 +842,13 @@ class Network(util.DaemonThread):
             self.process_pending_sends()
 
         self.stop_network()
+        self.wakeup.close()
         self.on_stop()
 
+    def stop(self):
+        util.DaemonThread.stop(self)
+        self.wakeup.set()
+
     def on_header(self, i, header):
         height = header.get('block_height')
         if not height:
@@ -32,20 +32,41 @@ import json
 import copy
 import re
 import stat
+import sqlite3
 
 from i18n import _
 from util import NotEnoughFunds, PrintError, profiler
 from plugins import run_hook, plugin_loaders
 from keystore import bip44_derivation
 
+# The journal is compacted into the wallet file once it grows larger
+# than the wallet file itself, and at least this many bytes
+JOURNAL_COMPACT_SIZE = 1000000
+
+
 class WalletStorage(PrintError):
 
-    def __init__(self, path):
+    def __new__(klass, path, use_journal=False):
+        # existing SQLite wallets are opened with the SQLite engine
+        if klass is WalletStorage and path and is_sqlite_file(path):
+            klass = SqliteWalletStorage
+        return object.__new__(klass)
+
+    def __init__(self, path, use_journal=False):
         self.lock = threading.RLock()
         self.data = {}
+        # keys whose value is shared with the caller, see get_shared()
+        self.shared = set()
         self.path = path
         self.file_exists = False
         self.modified = False
+        # In journal mode, changes are appended to a journal file as
+        # put/delete records instead of rewriting the whole wallet file.
+        self.use_journal = use_journal
+        self.journal = []
+        self.compaction_thread = None
+        self.journal_path = "%s.journal" % path
+        self.compacting_path = "%s.journal.compacting" % path
         self.print_error("wallet path", self.path)
         if self.path:
             self.read(self.path)
@@ -89,6 +110,45 @@ class WalletStorage(PrintError):
                     continue
                 self.data[key] = value
         self.file_exists = True
+        # a journal left by a previous session holds the latest changes
+        for path in [self.compacting_path, self.journal_path]:
+            if os.path.exists(path):
+                self.print_error("replaying", path)
+                self.replay_journal(self.data, path)
+                self.modified = True
+
+    @classmethod
+    def replay_journal(klass, data, path):
+        with open(path, "r") as f:
+            lines = f.read().split('\n')
+        for i, line in enumerate(lines):
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # an interrupted append may leave a truncated last record
+                if i == len(lines) - 1:
+                    break
+                raise IOError("Cannot read wallet journal '%s'" % path)
+            klass.apply_record(data, record)
+
+    @staticmethod
+    def apply_record(data, record):
+        op, key = record[0:2]
+        if op == 'set':
+            data[key] = record[2]
+        elif op == 'delete':
+            data.pop(key, None)
+        elif op == 'set_item':
+            d = data.get(key)
+            if type(d) is not dict:
+                d = data[key] = {}
+            d[record[2]] = record[3]
+        elif op == 'delete_item':
+            data.get(key, {}).pop(record[2], None)
+        else:
+            raise IOError("Unknown journal record", op)
 
     def get(self, key, default=None):
         with self.lock:
@@ -99,21 +159,94 @@ class WalletStorage(PrintError):
                 v = copy.deepcopy(v)
         return v
 
-    def put(self, key, value):
+    def get_shared(self, key, default=None):
+        '''Return the stored value itself instead of a copy.  The caller
+        and the storage share it from now on: the caller may change it
+        in place, and reports its changes with put() or put_item(),
+        which then neither copy nor compare the value.'''
+        with self.lock:
+            v = self.data.get(key)
+            if v is None:
+                if default is None:
+                    return None
+                v = self.data[key] = default
+            self.shared.add(key)
+        return v
+
+    def is_json(self, key, value):
         try:
-            json.dumps(key)
             json.dumps(value)
+            return True
         except:
             self.print_error("json error: cannot save", key)
-            return
+            return False
+
+    def put(self, key, value):
         with self.lock:
+            old_value = self.data.get(key)
             if value is not None:
-                if self.data.get(key) != value:
+                if value is old_value:
+                    # shared value, changed in place by the caller
+                    self.modified = True
+                    self.add_record(['set', key, value])
+                elif type(old_value) is dict and type(value) is dict:
+                    self.update_items(key, old_value, value)
+                elif old_value != value and self.is_json(key, value):
                     self.modified = True
                     self.data[key] = copy.deepcopy(value)
+                    self.shared.discard(key)
+                    self.add_record(['set', key, self.data[key]])
             elif key in self.data:
                 self.modified = True
                 self.data.pop(key)
+                self.shared.discard(key)
+                self.add_record(['delete', key])
+
+    def update_items(self, key, old_value, value):
+        '''Update a stored dict in place, copying only the items that
+        changed.  Large dicts (transactions, txi, txo...) usually change
+        by a few items between two saves.'''
+        for k in old_value.keys():
+            if k not in value:
+                self.modified = True
+                old_value.pop(k)
+                self.add_record(['delete_item', key, k])
+        for k, v in value.items():
+            if (k not in old_value or old_value[k] != v) and self.is_json(key, v):
+                self.modified = True
+                old_value[k] = copy.deepcopy(v)
+                self.add_record(['set_item', key, k, old_value[k]])
+
+    def put_item(self, key, item_key, value):
+        '''Set, or delete if value is None, a single item of the dict
+        stored under key.'''
+        with self.lock:
+            d = self.data.get(key)
+            if type(d) is not dict:
+                d = self.data[key] = {}
+            if key in self.shared:
+                # the caller owns the item, and may have changed or
+                # removed it from the shared dict already
+                self.modified = True
+                if value is not None:
+                    d[item_key] = value
+                    self.add_record(['set_item', key, item_key, value])
+                else:
+                    d.pop(item_key, None)
+                    self.add_record(['delete_item', key, item_key])
+            elif value is not None:
+                if (item_key not in d or d[item_key] != value) and self.is_json(key, value):
+                    self.modified = True
+                    d[item_key] = copy.deepcopy(value)
+                    self.add_record(['set_item', key, item_key, d[item_key]])
+            elif item_key in d:
+                self.modified = True
+                d.pop(item_key)
+                self.add_record(['delete_item', key, item_key])
+
+    def add_record(self, record):
+        if self.use_journal:
+            self.journal.append(record)
 
     def write(self):
         with self.lock:
@@ -126,23 +259,80 @@ class WalletStorage(PrintError):
             return
         if not self.modified:
             return
-        s = json.dumps(self.data, indent=4, sort_keys=True)
-        temp_path = "%s.tmp.%s" % (self.path, os.getpid())
+        if self.can_append():
+            self.append_journal()
+        else:
+            self.write_wallet_file()
+        self.modified = False
+
+    def can_append(self):
+        if not self.use_journal or not self.file_exists:
+            return False
+        # a journal whose compaction was interrupted is folded into
+        # the wallet file with a full write
+        if os.path.exists(self.compacting_path):
+            return self.compaction_thread is not None and self.compaction_thread.is_alive()
+        return True
+
+    def write_wallet_file(self):
+        # a background compaction must not overwrite what we write
+        if self.compaction_thread:
+            self.compaction_thread.join()
+        self.atomic_write(self.path, json.dumps(self.data, indent=4, sort_keys=True))
+        # the wallet file now contains every change
+        for path in [self.compacting_path, self.journal_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        self.journal = []
+        self.print_error("saved", self.path)
+
+    @staticmethod
+    def atomic_write(path, s):
+        temp_path = "%s.tmp.%s" % (path, os.getpid())
         with open(temp_path, "w") as f:
             f.write(s)
             f.flush()
             os.fsync(f.fileno())
 
-        mode = os.stat(self.path).st_mode if os.path.exists(self.path) else stat.S_IREAD | stat.S_IWRITE
+        mode = os.stat(path).st_mode if os.path.exists(path) else stat.S_IREAD | stat.S_IWRITE
         # perform atomic write on POSIX systems
         try:
-            os.rename(temp_path, self.path)
+            os.rename(temp_path, path)
         except:
-            os.remove(self.path)
-            os.rename(temp_path, self.path)
-        os.chmod(self.path, mode)
-        self.print_error("saved", self.path)
-        self.modified = False
+            os.remove(path)
+            os.rename(temp_path, path)
+        os.chmod(path, mode)
+
+    def append_journal(self):
+        s = ''.join(json.dumps(record) + '\n' for record in self.journal)
+        with open(self.journal_path, "a") as f:
+            f.write(s)
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal = []
+        self.print_error("appended %d bytes to journal" % len(s))
+        size = os.path.getsize(self.journal_path)
+        if size > max(JOURNAL_COMPACT_SIZE, os.path.getsize(self.path)):
+            self.start_compaction()
+
+    def start_compaction(self):
+        '''Fold the journal into the wallet file, in a background thread.
+        New records go to a fresh journal in the meantime.  If we crash
+        before the end, the wallet file is still valid and both journals
+        are replayed on the next read.'''
+        if self.compaction_thread and self.compaction_thread.is_alive():
+            return
+        os.rename(self.journal_path, self.compacting_path)
+        self.compaction_thread = threading.Thread(target=self.compact)
+        self.compaction_thread.start()
+
+    def compact(self):
+        with open(self.path, "r") as f:
+            data = json.loads(f.read())
+        self.replay_journal(data, self.compacting_path)
+        self.atomic_write(self.path, json.dumps(data, indent=4, sort_keys=True))
+        os.remove(self.compacting_path)
+        self.print_error("compacted journal into", self.path)
 
     def requires_split(self):
         d = self.get('accounts', {})
@@ -277,3 +467,150 @@ class WalletStorage(PrintError):
                     msg += "\nPlease open this file with Electrum 1.9.8, and move your coins to a new wallet."
             raise BaseException(msg)
         return seed_version
+
+
+SQLITE_HEADER = 'SQLite format 3\x00'
+
+def is_sqlite_file(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+    except IOError:
+        return False
+
+
+class SqliteWalletStorage(WalletStorage):
+    '''Wallet storage in an SQLite database.  The large transaction
+    dicts have a table each, with one row per item, and are updated
+    row by row.  Other keys are stored as JSON in the storage table.
+    Changes are committed by write().'''
+
+    # storage key -> (table, columns); the first column is the item key
+    tables = {
+        'transactions': ('transactions', 'tx_hash TEXT PRIMARY KEY, raw BLOB'),
+        'verified_tx3': ('verified_tx', 'tx_hash TEXT PRIMARY KEY, height INTEGER, timestamp INTEGER, pos INTEGER'),
+        'tx_fees': ('tx_fees', 'tx_hash TEXT PRIMARY KEY, fee INTEGER'),
+        'pruned_txo': ('pruned_txo', 'outpoint TEXT PRIMARY KEY, tx_hash TEXT'),
+        'txi': ('txi', 'tx_hash TEXT PRIMARY KEY, value TEXT'),
+        'txo': ('txo', 'tx_hash TEXT PRIMARY KEY, value TEXT'),
+        'addr_history': ('addr_history', 'address TEXT PRIMARY KEY, value TEXT'),
+    }
+    indexes = [
+        'CREATE INDEX IF NOT EXISTS verified_tx_height ON verified_tx (height)',
+        'CREATE INDEX IF NOT EXISTS pruned_txo_tx_hash ON pruned_txo (tx_hash)',
+    ]
+
+    def read(self, path):
+        self.file_exists = os.path.exists(path)
+        # the connection is shared by the wallet threads, under self.lock
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS storage (key TEXT PRIMARY KEY, value TEXT)')
+        for table, columns in self.tables.values():
+            self.conn.execute('CREATE TABLE IF NOT EXISTS %s (%s)' % (table, columns))
+        for sql in self.indexes:
+            self.conn.execute(sql)
+        self.conn.commit()
+
+    @staticmethod
+    def encode_row(key, item_key, value):
+        if key == 'transactions':
+            return (item_key, sqlite3.Binary(value.decode('hex')))
+        elif key == 'verified_tx3':
+            return (item_key,) + tuple(value)
+        elif key in ['tx_fees', 'pruned_txo']:
+            return (item_key, value)
+        else:
+            return (item_key, json.dumps(value))
+
+    @staticmethod
+    def decode_row(key, row):
+        if key == 'transactions':
+            value = str(row[1]).encode('hex')
+        elif key == 'verified_tx3':
+            value = tuple(row[1:])
+        elif key in ['tx_fees', 'pruned_txo']:
+            value = row[1]
+        else:
+            value = json.loads(row[1])
+        return row[0], value
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.tables:
+                table, columns = self.tables[key]
+                rows = self.conn.execute('SELECT * FROM %s' % table).fetchall()
+                if not rows:
+                    return default
+                return dict(self.decode_row(key, row) for row in rows)
+            row = self.conn.execute('SELECT value FROM storage WHERE key=?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def get_shared(self, key, default=None):
+        # values are decoded from the database, the caller owns them
+        return self.get(key, default)
+
+    def put(self, key, value):
+        # values are serialized once, into rows
+        try:
+            if key in self.tables:
+                rows = [self.encode_row(key, k, v) for k, v in value.items()] if value else []
+            elif value is not None:
+                s = json.dumps(value)
+        except:
+            self.print_error("json error: cannot save", key)
+            return
+        with self.lock:
+            self.modified = True
+            if key in self.tables:
+                table, columns = self.tables[key]
+                self.conn.execute('DELETE FROM %s' % table)
+                if rows:
+                    sql = 'INSERT INTO %s VALUES (%s)' % (table, ','.join('?' * len(rows[0])))
+                    self.conn.executemany(sql, rows)
+            elif value is not None:
+                self.conn.execute('INSERT OR REPLACE INTO storage VALUES (?,?)', (key, s))
+            else:
+                self.conn.execute('DELETE FROM storage WHERE key=?', (key,))
+
+    def put_item(self, key, item_key, value):
+        if key not in self.tables:
+            with self.lock:
+                d = self.get(key, {})
+                if value is not None:
+                    d[item_key] = value
+                else:
+                    d.pop(item_key, None)
+                self.put(key, d)
+            return
+        table, columns = self.tables[key]
+        with self.lock:
+            self.modified = True
+            if value is not None:
+                row = self.encode_row(key, item_key, value)
+                sql = 'INSERT OR REPLACE INTO %s VALUES (%s)' % (table, ','.join('?' * len(row)))
+                self.conn.execute(sql, row)
+            else:
+                sql = 'DELETE FROM %s WHERE %s=?' % (table, columns.split()[0])
+                self.conn.execute(sql, (item_key,))
+
+    def _write(self):
+        if threading.currentThread().isDaemon():
+            self.print_error('warning: daemon thread cannot write wallet')
+            return
+        if not self.modified:
+            return
+        self.conn.commit()
+        self.modified = False
+        self.print_error("saved", self.path)
+
+    @classmethod
+    def convert(klass, storage, path):
+        '''Copy a JSON wallet storage into a new SQLite wallet file.'''
+        if os.path.exists(path):
+            raise BaseException("File already exists: %s" % path)
+        new_storage = klass(path)
+        with storage.lock:
+            for key, value in storage.data.items():
+                new_storage.put(key, value)
+        new_storage.write()
+        return new_storage
@@ -24,11 +24,10 @@
 # SOFTWARE.
 
 
-from threading import Lock
+from threading import Lock, Thread
 import hashlib
 
-from bitcoin import Hash, hash_encode
-from transaction import Transaction
+from transaction import parse_transactions, BULK_PARSE_MIN
 from util import print_error, print_msg, ThreadJob
 
 
@@ -51,6 +50,11 @@ class Synchronizer(ThreadJob):
         self.requested_tx = set()
         self.requested_histories = {}
         self.requested_addrs = set()
+        # (tx_hash, tx_height, raw) of received txs, not parsed yet
+        self.received_txs = []
+        # (tx_hash, tx_height, tx) parsed by parse_thread
+        self.parsed_txs = []
+        self.parse_thread = None
         self.lock = Lock()
         self.initialize()
 
@@ -71,6 +75,7 @@ class Synchronizer(ThreadJob):
         '''This can be called from the proxy or GUI threads.'''
         with self.lock:
             self.new_addresses.add(address)
+        self.network.wakeup.set()
 
     def subscribe_to_addresses(self, addresses):
         if addresses:
@@ -136,22 +141,50 @@ class Synchronizer(ThreadJob):
         if not params:
             return
         tx_hash, tx_height = params
-        assert tx_hash == hash_encode(Hash(result.decode('hex')))
-        tx = Transaction(result)
-        try:
-            tx.deserialize()
-        except Exception:
-            self.print_msg("cannot deserialize transaction, skipping", tx_hash)
-            return
-        self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
-        self.requested_tx.remove((tx_hash, tx_height))
-        self.print_error("received tx %s height: %d bytes: %d" %
-                         (tx_hash, tx_height, len(tx.raw)))
-        # callbacks
-        self.network.trigger_callback('new_transaction', tx)
-        if not self.requested_tx:
-            self.network.trigger_callback('updated')
+        # parsed in bulk by add_received_txs()
+        with self.lock:
+            self.received_txs.append((tx_hash, tx_height, result))
 
+    def parse_txs(self, received):
+        txs = parse_transactions([(tx_hash, raw) for tx_hash, tx_height, raw in received])
+        return [(tx_hash, tx_height, tx) for (tx_hash, tx_height, raw), tx in zip(received, txs)]
+
+    def parse_txs_thread(self, received):
+        parsed = self.parse_txs(received)
+        with self.lock:
+            self.parsed_txs.extend(parsed)
+        # add them now, see run()
+        self.network.wakeup.set()
+
+    def add_received_txs(self):
+        '''Parse the received transactions and add them to the wallet.
+        Large batches, as received during the initial sync, are parsed
+        by a process pool in a separate thread, so that the network loop
+        is not blocked; they are added by a later call.'''
+        with self.lock:
+            parsed, self.parsed_txs = self.parsed_txs, []
+            if self.parse_thread is not None and self.parse_thread.is_alive():
+                received = []
+            else:
+                received, self.received_txs = self.received_txs, []
+        if len(received) >= BULK_PARSE_MIN:
+            self.parse_thread = Thread(target=self.parse_txs_thread, args=(received,))
+            self.parse_thread.daemon = True
+            self.parse_thread.start()
+        elif received:
+            parsed += self.parse_txs(received)
+        for tx_hash, tx_height, tx in parsed:
+            if tx is None:
+                self.print_msg("cannot deserialize transaction, skipping", tx_hash)
+                continue
+            self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
+            self.requested_tx.remove((tx_hash, tx_height))
+            self.print_error("received tx %s height: %d bytes: %d" %
+                             (tx_hash, tx_height, len(tx.raw)))
+            # callbacks
+            self.network.trigger_callback('new_transaction', tx)
+        if parsed and not self.requested_tx:
+            self.network.trigger_callback('updated')
 
     def request_missing_txs(self, hist):
         # "hist" is a list of [tx_hash, tx_height] lists
@@ -193,8 +226,14 @@ class Synchronizer(ThreadJob):
             self.new_addresses = set()
         self.subscribe_to_addresses(addresses)
 
-        # 3. Detect if situation has changed
+        # 3. Add received transactions
+        self.add_received_txs()
+
+        # 4. Detect if situation has changed
         up_to_date = self.is_up_to_date()
         if up_to_date != self.wallet.is_up_to_date():
             self.wallet.set_up_to_date(up_to_date)
             self.network.trigger_callback('updated')
+
+        # 5. Save what was received, if it is time to
+        self.wallet.save_pending_transactions()
@@ -1,3 +1,4 @@
+import hashlib
 import unittest
 import sys
 from ecdsa.util import number_to_string
@@ -7,7 +8,9 @@ from lib.bitcoin import (
     bip32_root, bip32_public_derivation, bip32_private_derivation, pw_encode,
     pw_decode, Hash, public_key_from_private_key, address_from_private_key,
     is_valid, is_private_key, xpub_from_xprv, is_new_seed, is_old_seed,
-    var_int, op_push)
+    var_int, op_push, ASecretToSecret, MySigningKey, SECP256k1, CKD_pub,
+    ec_backends, get_ec_backend, set_ec_backend, base_encode, base_decode,
+    DecodeBase58Check, hash_160_to_bc_address, bc_address_to_hash_160)
 
 try:
     import ecdsa
@@ -165,6 +168,35 @@ class Test_bitcoin(unittest.TestCase):
         self.assertEqual(op_push(0x10000), '4e00000100')
         self.assertEqual(op_push(0x12345678), '4e78563412')
 
+    def test_base58(self):
+        for hex_str, b58 in [
+                ('61', '2g'),
+                ('626262', 'a3gV'),
+                ('516b6fcd0f', 'ABnLTmg'),
+                ('00eb15231dfceb60925886b67d065299925915aeb172c06647', '1NS17iag9jJgTHD1VXjvLCEnZuQ3rJDE9L')]:
+            self.assertEqual(b58, base_encode(hex_str.decode('hex'), base=58))
+            self.assertEqual(hex_str.decode('hex'), base_decode(b58, None, base=58))
+        self.assertEqual(None, base_decode('a3gV', 4, base=58))
+        self.assertRaises(ValueError, base_decode, 'a3g0', None, base=58)
+        self.assertEqual(None, DecodeBase58Check('0OIl'))
+
+    def test_base43(self):
+        data = '\0\1hello world'
+        self.assertEqual('0385*FC:L2$I2ADPV$', base_encode(data, base=43))
+        self.assertEqual(data, base_decode(u'0385*FC:L2$I2ADPV$', None, base=43))
+        data = ''.join(chr(i % 256) for i in range(1000))
+        self.assertEqual(data, base_decode(base_encode(data, base=43), None, base=43))
+
+    def test_address_hash160(self):
+        h160 = '7719a1ba9cbb1a3e1d4e1c27cb1a3b4c4bde1b4a'.decode('hex')
+        addr = hash_160_to_bc_address(h160)
+        self.assertEqual(addr, '1Brk7kh52twa7JyNLhZmbouoHoNztMLUwi')
+        for i in range(2):
+            # the second time from the memo
+            self.assertEqual(addr, hash_160_to_bc_address(h160))
+            self.assertEqual((0, h160), bc_address_to_hash_160(addr))
+        self.assertEqual((5, h160), bc_address_to_hash_160(hash_160_to_bc_address(h160, 5)))
+
 
 class Test_keyImport(unittest.TestCase):
     """ The keys used in this class are TEST keys from
@@ -209,3 +241,54 @@ class Test_seeds(unittest.TestCase):
 
         self.assertTrue(is_old_seed("0123456789ABCDEF" * 2))
         self.assertTrue(is_old_seed("0123456789ABCDEF" * 4))
+
+
+class Test_ECBackends(unittest.TestCase):
+
+    private_key = "L52XzL2cMkHxqxBXRyEpnPQZGUs3uKiL3R11XbAdHigRzDozKZeW"
+    public_key_hex = "0339a36013301597daef41fbe593a02cc513d0b55527ec2df1050e2e8ff49c85c2"
+
+    def setUp(self):
+        self.backends = []
+        for klass in ec_backends:
+            try:
+                self.backends.append(klass())
+            except Exception:
+                pass
+        self.secret = ASecretToSecret(self.private_key)[0:32]
+        self.msg_hash = Hash('test')
+
+    def tearDown(self):
+        set_ec_backend()
+
+    def test_pubkey_from_secret(self):
+        for backend in self.backends:
+            self.assertEqual(self.public_key_hex, backend.pubkey_from_secret(self.secret).encode('hex'))
+            pubkey = backend.pubkey_from_secret(self.secret, False)
+            self.assertEqual(65, len(pubkey))
+            self.assertEqual(self.public_key_hex[2:], pubkey[1:33].encode('hex'))
+
+    def test_sign_verify_recover(self):
+        key = MySigningKey.from_string(self.secret, curve=SECP256k1)
+        expected = key.sign_digest_deterministic(self.msg_hash, hashfunc=hashlib.sha256, sigencode=ecdsa.util.sigencode_string)
+        pubkey = self.public_key_hex.decode('hex')
+        for backend in self.backends:
+            sig = backend.sign(self.msg_hash, self.secret)
+            self.assertEqual(expected, sig)
+            self.assertTrue(backend.verify(self.msg_hash, sig, pubkey))
+            self.assertFalse(backend.verify(Hash('other'), sig, pubkey))
+            recovered = [backend.recover(self.msg_hash, sig, recid) for recid in range(4)]
+            self.assertTrue(pubkey in recovered)
+
+    def test_tweak_add(self):
+        c = Hash('chain code')
+        for backend in self.backends:
+            set_ec_backend(backend.name)
+            self.assertEqual('030ae0de85b0b2974c0be0c991e2932a20c8547b5e178397aff53a6b0a82b61080',
+                             CKD_pub(self.public_key_hex.decode('hex'), c, 7)[0].encode('hex'))
+            self.assertRaises(Exception, backend.tweak_add, self.public_key_hex.decode('hex'), '\xff' * 32)
+
+    def test_set_ec_backend(self):
+        self.assertEqual('python', set_ec_backend('python'))
+        self.assertEqual('python', get_ec_backend().name)
+        self.assertRaises(BaseException, set_ec_backend, 'no such backend')
@@ -0,0 +1,58 @@
+import random
+import unittest
+
+from ecdsa.ecdsa import generator_secp256k1
+
+from lib import ecc
+from lib.bitcoin import point_to_ser
+
+
+def ecdsa_mul(k, point=generator_secp256k1):
+    p = point * k
+    return p.x(), p.y()
+
+
+class TestEcc(unittest.TestCase):
+
+    scalars = [1, 2, 3, 15, 16, 17, 255, 256, ecc.N - 2, ecc.N - 1]
+
+    def setUp(self):
+        self.rand = random.Random(42)
+        self.scalars = self.scalars + [self.rand.randrange(1, ecc.N) for i in range(20)]
+
+    def test_generator_mul(self):
+        for k in self.scalars:
+            self.assertEqual(ecdsa_mul(k), ecc.generator_mul(k))
+        self.assertEqual(None, ecc.generator_mul(0))
+        self.assertEqual(None, ecc.generator_mul(ecc.N))
+
+    def test_point_mul(self):
+        point = generator_secp256k1 * self.rand.randrange(1, ecc.N)
+        for k in self.scalars:
+            self.assertEqual(ecdsa_mul(k, point), ecc.point_mul(k, (point.x(), point.y())))
+        self.assertEqual(None, ecc.point_mul(ecc.N, ecc.G))
+
+    def test_mul_add(self):
+        for k in self.scalars:
+            point = generator_secp256k1 * self.rand.randrange(1, ecc.N)
+            q = generator_secp256k1 * k + point
+            self.assertEqual((q.x(), q.y()), ecc.mul_add(k, (point.x(), point.y())))
+        # doubling and cancellation
+        self.assertEqual(ecc.generator_mul(2), ecc.mul_add(1, ecc.G))
+        self.assertEqual(None, ecc.mul_add(1, (ecc.G[0], ecc.P - ecc.G[1])))
+
+    def test_ser_deser(self):
+        for k in self.scalars:
+            point = generator_secp256k1 * k
+            for compressed in [True, False]:
+                s = ecc.ser((point.x(), point.y()), compressed)
+                self.assertEqual(point_to_ser(point, compressed), s)
+                self.assertEqual((point.x(), point.y()), ecc.deser(s))
+
+    def test_deser_invalid(self):
+        s = ecc.ser(ecc.G, False)
+        self.assertRaises(ValueError, ecc.deser, s[:-1] + chr(ord(s[-1]) ^ 1))
+        self.assertRaises(ValueError, ecc.deser, '\x05' + s[1:])
+        self.assertRaises(ValueError, ecc.deser, '\x02' + '\xff' * 32)
+        # 5 is not the x coordinate of a point
+        self.assertRaises(ValueError, ecc.deser, '\x02' + '\x00' * 31 + '\x05')
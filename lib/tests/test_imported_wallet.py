@@ -0,0 +1,258 @@
+import shutil
+import tempfile
+import unittest
+import os
+import time
+
+from lib.storage import WalletStorage, SqliteWalletStorage
+from lib.transaction import Transaction
+from lib.wallet import Imported_Wallet
+
+
+class ImportedWalletTestCase(unittest.TestCase):
+
+    storage_class = WalletStorage
+    addresses = [
+        '15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma',
+        '1KSezYMhAJMWqFbVFB2JshYg69UpmEXR4D',
+        '1CQj15y1N7LDHp7wTt28eoD1QhHgFgxECH',
+    ]
+
+    def setUp(self):
+        super(ImportedWalletTestCase, self).setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.wallet_path = os.path.join(self.user_dir, "somewallet")
+        storage = self.storage_class(self.wallet_path)
+        storage.put('wallet_type', 'imported')
+        storage.put('addresses', self.addresses[:2])
+        self.wallet = Imported_Wallet(storage)
+
+    def tearDown(self):
+        super(ImportedWalletTestCase, self).tearDown()
+        shutil.rmtree(self.user_dir)
+
+
+class TestAddressIndex(ImportedWalletTestCase):
+
+    def test_loaded_addresses_are_indexed(self):
+        self.assertTrue(self.wallet.is_mine(self.addresses[0]))
+        self.assertFalse(self.wallet.is_mine(self.addresses[2]))
+        self.assertEqual((False, 1), self.wallet.get_address_index(self.addresses[1]))
+        self.assertFalse(self.wallet.is_change(self.addresses[1]))
+
+    def test_unknown_address(self):
+        self.assertFalse(self.wallet.is_change(self.addresses[2]))
+        with self.assertRaises(Exception):
+            self.wallet.get_address_index(self.addresses[2])
+
+    def test_import_and_delete_address(self):
+        self.wallet.import_address(self.addresses[2])
+        self.assertTrue(self.wallet.is_mine(self.addresses[2]))
+        self.assertEqual((False, 2), self.wallet.get_address_index(self.addresses[2]))
+
+        self.wallet.delete_address(self.addresses[0])
+        self.assertFalse(self.wallet.is_mine(self.addresses[0]))
+        self.assertEqual((False, 0), self.wallet.get_address_index(self.addresses[1]))
+        self.assertEqual((False, 1), self.wallet.get_address_index(self.addresses[2]))
+
+
+signed_blob = '01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000006c493046022100a82bbc57a0136751e5433f41cf000b3f1a99c6744775e76ec764fb78c54ee100022100f9e80b7de89de861dc6fb0c1429d5da72c2b6b2ee2406bc9bfb1beedd729d985012102e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6ffffffff0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388ac00000000'
+signed_blob_prevout = '3140eb24b43386f35ba69e3875eb6c93130ac66201d01c58f598defc949a5c2a:0'
+
+
+class TestSaveTransactions(ImportedWalletTestCase):
+
+    addresses = [
+        '14CHYaaByjJZpx4oHBpfDMdqhTyXnZ3kVs',
+        '1446oU3z268EeFgfcwJv6X2VBXHfoYxfuD',
+    ]
+
+    def setUp(self):
+        super(TestSaveTransactions, self).setUp()
+        self.tx = Transaction(signed_blob)
+        self.tx_hash = self.tx.hash()
+        self.wallet.add_transaction(self.tx_hash, self.tx)
+        self.wallet.save_transactions(write=True)
+
+    def test_added_transaction_is_saved(self):
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual({self.tx_hash: signed_blob}, storage.get('transactions'))
+        self.assertEqual({self.addresses[0]: [[0, 1000000, False]]}, storage.get('txo')[self.tx_hash])
+        self.assertEqual({}, storage.get('txi')[self.tx_hash])
+        self.assertEqual({signed_blob_prevout: self.tx_hash}, storage.get('pruned_txo'))
+
+    def test_removed_transaction_is_deleted(self):
+        self.wallet.remove_transaction(self.tx_hash)
+        self.wallet.save_transactions(write=True)
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual({}, storage.get('txi', {}))
+        self.assertEqual({}, storage.get('txo', {}))
+        self.assertEqual({}, storage.get('pruned_txo', {}))
+
+    def test_unchanged_items_are_not_rewritten(self):
+        self.wallet.save_transactions()
+        self.assertFalse(self.wallet.storage.modified)
+
+
+class TestSaveTransactionsSqlite(TestSaveTransactions):
+
+    storage_class = SqliteWalletStorage
+
+    def test_storage_type(self):
+        self.assertTrue(isinstance(WalletStorage(self.wallet_path), SqliteWalletStorage))
+
+
+class TestAddressCache(ImportedWalletTestCase):
+
+    addresses = [
+        '14CHYaaByjJZpx4oHBpfDMdqhTyXnZ3kVs',
+        '1446oU3z268EeFgfcwJv6X2VBXHfoYxfuD',
+    ]
+
+    def setUp(self):
+        super(TestAddressCache, self).setUp()
+        self.tx_hash = Transaction(signed_blob).hash()
+        self.wallet.receive_tx_callback(self.tx_hash, Transaction(signed_blob), 0)
+
+    def receive_history(self, hist):
+        self.wallet.receive_history_callback(self.addresses[0], hist, {})
+
+    def test_balance_follows_history(self):
+        self.assertEqual((0, 0, 0), self.wallet.get_addr_balance(self.addresses[0]))
+        self.receive_history([(self.tx_hash, 0)])
+        self.assertEqual((0, 1000000, 0), self.wallet.get_addr_balance(self.addresses[0]))
+        self.receive_history([(self.tx_hash, 100)])
+        self.assertEqual((1000000, 0, 0), self.wallet.get_addr_balance(self.addresses[0]))
+        self.assertEqual(1000000, self.wallet.get_addr_received(self.addresses[0]))
+        self.assertEqual((1000000, 0, 0), self.wallet.get_balance())
+        self.receive_history([])
+        self.assertEqual((0, 0, 0), self.wallet.get_addr_balance(self.addresses[0]))
+        self.assertEqual([], self.wallet.get_spendable_coins())
+
+    def test_spendable_coins(self):
+        self.receive_history([(self.tx_hash, 100)])
+        coins = self.wallet.get_spendable_coins()
+        self.assertEqual([{
+            'address': self.addresses[0],
+            'value': 1000000,
+            'prevout_n': 0,
+            'prevout_hash': self.tx_hash,
+            'height': 100,
+            'coinbase': False,
+        }], coins)
+        # callers get copies of the cached coins
+        coins[0]['value'] = 0
+        self.assertEqual(1000000, self.wallet.get_spendable_coins()[0]['value'])
+        self.wallet.set_frozen_state([self.addresses[0]], True)
+        self.assertEqual([], self.wallet.get_spendable_coins())
+
+
+class TestTxiIndex(ImportedWalletTestCase):
+
+    addresses = [
+        '14CHYaaByjJZpx4oHBpfDMdqhTyXnZ3kVs',
+        '1446oU3z268EeFgfcwJv6X2VBXHfoYxfuD',
+    ]
+
+    def setUp(self):
+        super(TestTxiIndex, self).setUp()
+        self.tx_hash = Transaction(signed_blob).hash()
+        self.prevout_hash = signed_blob_prevout.split(':')[0]
+
+    def test_pruned_input(self):
+        self.wallet.add_transaction(self.tx_hash, Transaction(signed_blob))
+        self.assertEqual({self.tx_hash: set([signed_blob_prevout])}, self.wallet.pruned_by_tx)
+        self.assertEqual({}, self.wallet.spending_txs)
+        self.wallet.remove_transaction(self.tx_hash)
+        self.assertEqual({}, self.wallet.pruned_by_tx)
+        self.assertEqual({}, self.wallet.pruned_txo)
+
+    def test_remove_spent_transaction(self):
+        # the wallet knows the output spent by the transaction
+        self.wallet.txo[self.prevout_hash] = {self.addresses[1]: [(0, 2000000, False)]}
+        self.wallet.add_transaction(self.tx_hash, Transaction(signed_blob))
+        self.assertEqual({self.addresses[1]: [(signed_blob_prevout, 2000000)]}, self.wallet.txi[self.tx_hash])
+        self.assertEqual({self.prevout_hash: set([self.tx_hash])}, self.wallet.spending_txs)
+        self.assertEqual({}, self.wallet.pruned_by_tx)
+
+        self.wallet.remove_transaction(self.prevout_hash)
+        self.assertEqual({}, self.wallet.txi[self.tx_hash])
+        self.assertEqual({signed_blob_prevout: self.tx_hash}, self.wallet.pruned_txo)
+        self.assertEqual({self.tx_hash: set([signed_blob_prevout])}, self.wallet.pruned_by_tx)
+        self.assertEqual({}, self.wallet.spending_txs)
+
+
+unsigned_blob = '01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000005701ff4c53ff0488b21e03ef2afea18000000089689bff23e1e7fb2f161daa37270a97a3d8c2e537584b2d304ecb47b86d21fc021b010d3bd425f8cf2e04824bfdf1f1f5ff1d51fadd9a41f9e3fb8dd3403b1bfe00000000ffffffff0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388ac00000000'
+
+
+class TestHistory(ImportedWalletTestCase):
+
+    addresses = ['14CHYaaByjJZpx4oHBpfDMdqhTyXnZ3kVs']
+
+    def setUp(self):
+        super(TestHistory, self).setUp()
+        # two transactions paying 1000000 to the wallet
+        self.tx_hashes = []
+        for blob in [signed_blob, unsigned_blob]:
+            tx = Transaction(blob)
+            self.tx_hashes.append(tx.hash())
+            self.wallet.receive_tx_callback(tx.hash(), tx, 0)
+
+    def receive_history(self, hist):
+        self.wallet.receive_history_callback(self.addresses[0], hist, {})
+
+    def test_history_is_ordered(self):
+        h1, h2 = self.tx_hashes
+        self.receive_history([(h1, 200), (h2, 100)])
+        expected = [(h2, 100, 0, False, 1000000, 1000000), (h1, 200, 0, False, 1000000, 2000000)]
+        self.assertEqual(expected, self.wallet.get_history())
+        self.assertEqual(expected, self.wallet.get_history(self.addresses))
+        # a new position moves the row
+        self.receive_history([(h1, 50), (h2, 100)])
+        self.assertEqual([h1, h2], [item[0] for item in self.wallet.get_history()])
+
+    def test_pages(self):
+        h1, h2 = self.tx_hashes
+        self.receive_history([(h1, 100), (h2, 200)])
+        self.assertEqual([(h2, 200, 0, False, 1000000, 2000000)], self.wallet.get_history(limit=1))
+        self.assertEqual([(h1, 100, 0, False, 1000000, 1000000)], self.wallet.get_history(offset=1, limit=1))
+        self.assertEqual([], self.wallet.get_history(offset=2))
+        self.assertEqual(self.wallet.get_history(offset=1), self.wallet.get_history(self.addresses, offset=1))
+
+    def test_removed_transaction(self):
+        h1, h2 = self.tx_hashes
+        self.receive_history([(h1, 100), (h2, 200)])
+        self.receive_history([(h2, 200)])
+        self.assertEqual([(h2, 200, 0, False, 1000000, 1000000)], self.wallet.get_history())
+
+
+class TestSaveRequests(ImportedWalletTestCase):
+
+    addresses = ['14CHYaaByjJZpx4oHBpfDMdqhTyXnZ3kVs']
+
+    def receive_transactions(self):
+        for blob in [signed_blob, unsigned_blob]:
+            tx = Transaction(blob)
+            self.wallet.receive_tx_callback(tx.hash(), tx, 0)
+
+    def test_saves_are_coalesced(self):
+        self.wallet.last_save = time.time()
+        self.receive_transactions()
+        self.wallet.save_pending_transactions()
+        self.assertEqual(2, self.wallet.save_requests)
+        self.assertEqual(0, self.wallet.saves)
+        self.assertTrue(self.wallet.changed_items)
+
+        self.wallet.last_save = 0
+        self.wallet.save_pending_transactions()
+        self.assertEqual(1, self.wallet.saves)
+        self.assertFalse(self.wallet.changed_items)
+        self.assertFalse(self.wallet.save_pending)
+
+    def test_save_when_up_to_date(self):
+        self.wallet.last_save = time.time()
+        self.receive_transactions()
+        self.wallet.set_up_to_date(True)
+        self.assertEqual(1, self.wallet.saves)
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual(2, len(storage.get('transactions')))
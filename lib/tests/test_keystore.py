@@ -0,0 +1,67 @@
+import unittest
+
+from lib import bitcoin, keystore
+from lib.storage import WalletStorage
+from lib.util import InvalidPassword
+
+
+class TestUnlockedKeys(unittest.TestCase):
+
+    xprv = 'xprv9s21ZrQH143K3QTDL4LXw2F7HEK3wJUD2nW2nRk4stbPy6cq3jPPqjiChkVvvNKmPGJxWUtg6LnF5kejMRNNU3TGtRBeJgk33yuGBxrMPHi'
+    secs = ['5HueCGU8rMjxEXxiPuD5BDku4MkFqeZyd4dZ1jvhTVqvbTLvyTJ',
+            'KwdMAjGmerYanjeui5SHS7JkmpZvVipYvB2LJGU1ZxJwYvP98617']
+
+    def count_decrypt(self, ks):
+        calls = []
+        decrypt = ks.decrypt
+        def counting_decrypt(password):
+            calls.append(password)
+            return decrypt(password)
+        ks.decrypt = counting_decrypt
+        return calls
+
+    def test_bip32(self):
+        ks = keystore.from_xprv(self.xprv, 'secret')
+        _, _, _, c, k = bitcoin.deserialize_xkey(self.xprv)
+        calls = self.count_decrypt(ks)
+        with ks.unlocked('secret') as keys:
+            for sequence in [(0, 0), (0, 1), (1, 0), [1, 5]]:
+                self.assertEqual(bitcoin.bip32_private_key(sequence, k, c), keys.get_private_key(sequence))
+                self.assertEqual(bitcoin.bip32_private_key(sequence, k, c), ks.get_private_key(sequence, 'secret'))
+            self.assertTrue(ks.unlocked('secret') is keys)
+            self.assertEqual(2, len(keys.cache))
+        self.assertEqual(['secret'], calls)
+        # everything is dropped on exit
+        self.assertEqual(None, keys.secret)
+        self.assertEqual({}, keys.keys)
+        self.assertEqual({}, keys.cache)
+        self.assertEqual(None, ks.unlocked_keys)
+        self.assertEqual(bitcoin.bip32_private_key((0, 2), k, c), ks.get_private_key((0, 2), 'secret'))
+        self.assertEqual(['secret'] * 2, calls)
+
+    def test_wrong_password(self):
+        ks = keystore.from_xprv(self.xprv, 'secret')
+        with self.assertRaises(InvalidPassword):
+            with ks.unlocked('wrong'):
+                pass
+        with ks.unlocked('secret'):
+            self.assertRaises(InvalidPassword, ks.get_private_key, (0, 0), 'wrong')
+
+    def test_imported(self):
+        storage = WalletStorage(None)
+        keystore.from_private_key_list(' '.join(self.secs), None).save(storage, None)
+        ks = keystore.load_keystore(storage, None)
+        with ks.unlocked(None) as keys:
+            secs = [keys.get_private_key((0, i)) for i in range(2)]
+        self.assertEqual(sorted(self.secs), sorted(secs))
+        pubkeys = [bitcoin.public_key_from_private_key(sec) for sec in secs]
+        self.assertEqual(ks.receiving_pubkeys, pubkeys)
+
+    def test_several_keystores(self):
+        keystores = [keystore.from_xprv(self.xprv, 'secret'), keystore.from_xpub(bitcoin.xpub_from_xprv(self.xprv))]
+        calls = self.count_decrypt(keystores[0])
+        with keystore.UnlockedKeyStores(keystores, 'secret'):
+            self.assertTrue(keystores[0].unlocked_keys.depth)
+            keystores[0].get_private_key((0, 0), 'secret')
+        self.assertEqual(None, keystores[0].unlocked_keys)
+        self.assertEqual(['secret'], calls)
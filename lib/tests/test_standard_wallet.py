@@ -0,0 +1,52 @@
+import shutil
+import tempfile
+import unittest
+import os
+
+from lib import bitcoin
+from lib.keystore import Xpub
+from lib.storage import WalletStorage
+from lib.version import NEW_SEED_VERSION
+from lib.wallet import Standard_Wallet
+
+
+class TestSynchronize(unittest.TestCase):
+
+    xpub = "xpub6H1LXWLaKsWFhvm6RVpEL9P4KfRZSW7abD2ttkWP3SSQvnyA8FSVqNTEcYFgJS2UaFcxupHiYkro49S8yGasTvXEYBVPamhGW6cFJodrTHy"
+
+    def setUp(self):
+        super(TestSynchronize, self).setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.wallet_path = os.path.join(self.user_dir, "somewallet")
+        storage = WalletStorage(self.wallet_path)
+        storage.put('wallet_type', 'standard')
+        storage.put('seed_version', NEW_SEED_VERSION)
+        storage.put('master_public_keys', {'x/': self.xpub})
+        self.wallet = Standard_Wallet(storage)
+
+    def tearDown(self):
+        super(TestSynchronize, self).tearDown()
+        shutil.rmtree(self.user_dir)
+
+    def test_derive_pubkeys(self):
+        keystore = self.wallet.keystore
+        pubkeys = keystore.derive_pubkeys(1, 3, 4)
+        self.assertEqual([Xpub.derive_pubkey_from_xpub(self.xpub, 1, n) for n in range(3, 7)], pubkeys)
+        self.assertEqual(pubkeys[0], keystore.derive_pubkey(1, 3))
+
+    def test_gap_limit(self):
+        self.wallet.synchronize()
+        self.assertEqual(20, len(self.wallet.get_receiving_addresses()))
+        self.assertEqual(6, len(self.wallet.get_change_addresses()))
+        pubkey = self.wallet.receiving_pubkeys[19]
+        self.assertEqual(Xpub.derive_pubkey_from_xpub(self.xpub, 0, 19), pubkey)
+        self.assertEqual(bitcoin.public_key_to_bc_address(pubkey.decode('hex')),
+                         self.wallet.get_receiving_addresses()[19])
+
+        # the last address gets old: a new block of addresses is created
+        self.wallet.stored_height = 1000
+        self.wallet.history[self.wallet.get_receiving_addresses()[15]] = [('aa', 100)]
+        self.wallet.synchronize()
+        self.assertEqual(36, len(self.wallet.get_receiving_addresses()))
+        self.assertEqual((False, 35), self.wallet.get_address_index(self.wallet.get_receiving_addresses()[35]))
+        self.assertEqual(36, len(self.wallet.storage.get('accounts')['0']['receiving']))
@@ -0,0 +1,178 @@
+import shutil
+import tempfile
+import unittest
+import json
+import os
+
+from lib import storage
+from lib.storage import WalletStorage, SqliteWalletStorage
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        super(TestJournal, self).setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.wallet_path = os.path.join(self.user_dir, "somewallet")
+        s = WalletStorage(self.wallet_path, use_journal=True)
+        s.put('labels', {'a': 'b'})
+        s.put('gap_limit', 20)
+        s.write()
+        self.storage = WalletStorage(self.wallet_path, use_journal=True)
+
+    def tearDown(self):
+        super(TestJournal, self).tearDown()
+        shutil.rmtree(self.user_dir)
+
+    def read_wallet_file(self):
+        with open(self.wallet_path, "r") as f:
+            return json.loads(f.read())
+
+    def test_first_write_creates_wallet_file(self):
+        self.assertEqual({'labels': {'a': 'b'}, 'gap_limit': 20}, self.read_wallet_file())
+        self.assertFalse(os.path.exists(self.storage.journal_path))
+
+    def test_changes_are_appended(self):
+        self.storage.put('labels', {'a': 'b', 'c': 'd'})
+        self.storage.put('gap_limit', None)
+        self.storage.write()
+        self.assertEqual({'labels': {'a': 'b'}, 'gap_limit': 20}, self.read_wallet_file())
+        with open(self.storage.journal_path, "r") as f:
+            records = map(json.loads, f.read().splitlines())
+        self.assertEqual([['set_item', 'labels', 'c', 'd'], ['delete', 'gap_limit']], records)
+
+        s = WalletStorage(self.wallet_path)
+        self.assertEqual({'a': 'b', 'c': 'd'}, s.get('labels'))
+        self.assertEqual(None, s.get('gap_limit'))
+
+    def test_truncated_record_is_ignored(self):
+        self.storage.put('labels', {'a': 'x'})
+        self.storage.write()
+        with open(self.storage.journal_path, "a") as f:
+            f.write('["set", "gap_lim')
+        s = WalletStorage(self.wallet_path)
+        self.assertEqual({'a': 'x'}, s.get('labels'))
+        self.assertEqual(20, s.get('gap_limit'))
+
+    def test_compaction(self):
+        saved = storage.JOURNAL_COMPACT_SIZE
+        storage.JOURNAL_COMPACT_SIZE = 0
+        try:
+            self.storage.put('labels', {'a': 'x' * 1000})
+            self.storage.write()
+            self.storage.compaction_thread.join()
+        finally:
+            storage.JOURNAL_COMPACT_SIZE = saved
+        self.assertEqual({'a': 'x' * 1000}, self.read_wallet_file()['labels'])
+        self.assertFalse(os.path.exists(self.storage.compacting_path))
+        self.assertFalse(os.path.exists(self.storage.journal_path))
+
+    def test_full_write_without_journal(self):
+        s = WalletStorage(self.wallet_path)
+        s.put('gap_limit', 30)
+        s.write()
+        self.assertEqual(30, self.read_wallet_file()['gap_limit'])
+
+
+
+class TestSharedValues(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSharedValues, self).setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.wallet_path = os.path.join(self.user_dir, "somewallet")
+        s = WalletStorage(self.wallet_path)
+        s.put('txi', {'aa': {}})
+        s.write()
+        self.storage = WalletStorage(self.wallet_path, use_journal=True)
+
+    def tearDown(self):
+        super(TestSharedValues, self).tearDown()
+        shutil.rmtree(self.user_dir)
+
+    def test_value_is_not_copied(self):
+        txi = self.storage.get_shared('txi')
+        self.assertTrue(txi is self.storage.get_shared('txi'))
+        self.assertEqual({}, self.storage.get_shared('txo', {}))
+        self.assertEqual(None, self.storage.get_shared('tx_fees'))
+        self.assertFalse(self.storage.modified)
+
+    def test_changes_made_in_place(self):
+        txi = self.storage.get_shared('txi')
+        txi['bb'] = {'addr': [['cc:0', 1000]]}
+        txi.pop('aa')
+        self.storage.put_item('txi', 'bb', txi['bb'])
+        self.storage.put_item('txi', 'aa', None)
+        self.storage.write()
+        s = WalletStorage(self.wallet_path)
+        self.assertEqual({'bb': {'addr': [['cc:0', 1000]]}}, s.get('txi'))
+
+    def test_put_same_value(self):
+        txi = self.storage.get_shared('txi')
+        txi['bb'] = {}
+        self.storage.put('txi', txi)
+        self.assertTrue(self.storage.modified)
+        self.storage.write()
+        s = WalletStorage(self.wallet_path)
+        self.assertEqual({'aa': {}, 'bb': {}}, s.get('txi'))
+
+
+class TestSqliteStorage(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSqliteStorage, self).setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.wallet_path = os.path.join(self.user_dir, "somewallet")
+
+    def tearDown(self):
+        super(TestSqliteStorage, self).tearDown()
+        shutil.rmtree(self.user_dir)
+
+    def test_put_and_get(self):
+        s = SqliteWalletStorage(self.wallet_path)
+        s.put('gap_limit', 20)
+        s.put('verified_tx3', {'aa': (100, 1234, 3)})
+        s.put_item('transactions', 'aa', '0100')
+        s.put_item('txo', 'aa', {'addr': [[0, 1000, False]]})
+        s.put_item('labels', 'aa', 'label')
+        s.write()
+        s = WalletStorage(self.wallet_path)
+        self.assertTrue(isinstance(s, SqliteWalletStorage))
+        self.assertEqual(20, s.get('gap_limit'))
+        self.assertEqual({'aa': (100, 1234, 3)}, s.get('verified_tx3'))
+        self.assertEqual({'aa': '0100'}, s.get('transactions'))
+        self.assertEqual({'aa': {'addr': [[0, 1000, False]]}}, s.get('txo'))
+        self.assertEqual({'aa': 'label'}, s.get('labels'))
+
+    def test_delete(self):
+        s = SqliteWalletStorage(self.wallet_path)
+        s.put('gap_limit', 20)
+        s.put('txi', {'aa': {}, 'bb': {}})
+        s.put_item('txi', 'aa', None)
+        s.put('gap_limit', None)
+        s.write()
+        s = WalletStorage(self.wallet_path)
+        self.assertEqual({'bb': {}}, s.get('txi'))
+        self.assertEqual(None, s.get('gap_limit'))
+        self.assertEqual({}, s.get('addr_history', {}))
+
+    def test_uncommitted_changes_are_lost(self):
+        s = SqliteWalletStorage(self.wallet_path)
+        s.put('gap_limit', 20)
+        s.write()
+        s.put('gap_limit', 30)
+        s = WalletStorage(self.wallet_path)
+        self.assertEqual(20, s.get('gap_limit'))
+
+    def test_convert(self):
+        json_path = os.path.join(self.user_dir, "jsonwallet")
+        s = WalletStorage(json_path)
+        s.put('gap_limit', 20)
+        s.put('addr_history', {'addr': [['aa', 100]]})
+        s.put('tx_fees', {'aa': 1000})
+        s.write()
+        SqliteWalletStorage.convert(s, self.wallet_path)
+        s = WalletStorage(self.wallet_path)
+        self.assertEqual(20, s.get('gap_limit'))
+        self.assertEqual({'addr': [['aa', 100]]}, s.get('addr_history'))
+        self.assertEqual({'aa': 1000}, s.get('tx_fees'))
@@ -1,5 +1,6 @@
 import unittest
-from lib import transaction
+import ecdsa
+from lib import bitcoin, transaction
 from lib.bitcoin import TYPE_ADDRESS
 
 import pprint
@@ -49,6 +50,19 @@ class TestBCDataStream(unittest.TestCase):
         self.assertEquals(s.read_bytes(4), 'r')
         self.assertEquals(s.read_bytes(1), '')
 
+    def test_read_in_place(self):
+        s = transaction.BCDataStream('\x01\x00\x00\x00\x03abc')
+        self.assertEquals(s.read_uint32(), 1)
+        self.assertEquals(s.read_string(), 'abc')
+
+    def test_write_after_read(self):
+        s = transaction.BCDataStream()
+        s.write_uint16(7)
+        self.assertEquals(s.read_uint16(), 7)
+        s.write_string('xyz')
+        self.assertEquals(s.read_string(), 'xyz')
+        self.assertEquals(s.input, '\x07\x00\x03xyz')
+
 class TestTransaction(unittest.TestCase):
 
     def test_tx_unsigned(self):
@@ -143,6 +157,265 @@ class TestTransaction(unittest.TestCase):
         self.assertEquals(res, (None, '1CQj15y1N7LDHp7wTt28eoD1QhHgFgxECH'))
 
 
+class TestTxInput(unittest.TestCase):
+
+    def test_dict_interface(self):
+        txin = transaction.TxInput(prevout_hash='aa', prevout_n=1)
+        txin['label'] = 'extra key'
+        self.assertEqual('aa', txin['prevout_hash'])
+        self.assertEqual('extra key', txin['label'])
+        self.assertEqual(None, txin.get('address'))
+        self.assertRaises(KeyError, lambda: txin['address'])
+        self.assertFalse('address' in txin)
+        self.assertEqual([None], txin.setdefault('signatures', [None]))
+        self.assertEqual(['label', 'prevout_hash', 'prevout_n', 'signatures'], sorted(txin))
+        self.assertEqual(1, txin.pop('prevout_n'))
+        self.assertEqual(None, txin.pop('prevout_n', None))
+        del txin['label']
+        self.assertRaises(KeyError, txin.__delitem__, 'label')
+        self.assertEqual({'prevout_hash': 'aa', 'signatures': [None]}, dict(txin))
+        self.assertEqual(txin, {'prevout_hash': 'aa', 'signatures': [None]})
+        self.assertNotEqual(txin, {'prevout_hash': 'aa'})
+        copy = txin.copy()
+        copy['prevout_hash'] = 'bb'
+        self.assertEqual('aa', txin['prevout_hash'])
+
+    def test_parsed_inputs(self):
+        tx = transaction.Transaction(signed_blob)
+        txin = tx.inputs()[0]
+        self.assertTrue(isinstance(txin, transaction.TxInput))
+        self.assertEqual('1446oU3z268EeFgfcwJv6X2VBXHfoYxfuD', txin['address'])
+        self.assertEqual(signed_blob, tx.serialize())
+        self.assertEqual([(TYPE_ADDRESS, '14CHYaaByjJZpx4oHBpfDMdqhTyXnZ3kVs', 1000000)], tx.outputs())
+        self.assertEqual(1000000, tx.outputs()[0].value)
+
+
+class TestTransactionStore(unittest.TestCase):
+
+    def setUp(self):
+        super(TestTransactionStore, self).setUp()
+        self.raw = {'aa': signed_blob, 'bb': unsigned_blob}
+        self.store = transaction.TransactionStore(self.raw, cache_size=1)
+
+    def test_transactions_are_parsed_on_demand(self):
+        self.assertEqual(0, len(self.store.cache))
+        tx = self.store.get('aa')
+        self.assertEqual(signed_blob, tx.raw)
+        self.assertTrue(tx is self.store['aa'])
+        self.assertEqual(None, self.store.get('cc'))
+        with self.assertRaises(KeyError):
+            self.store['cc']
+
+    def test_cache_is_bounded(self):
+        self.store.get('aa')
+        self.store.get('bb')
+        self.assertEqual(['bb'], self.store.cache.keys())
+        self.assertEqual(signed_blob, self.store.get('aa').raw)
+
+    def test_set_and_pop(self):
+        self.store['cc'] = transaction.Transaction(signed_blob)
+        self.assertEqual(signed_blob, self.raw['cc'])
+        self.assertTrue('cc' in self.store)
+        self.assertEqual(signed_blob, self.store.pop('aa').raw)
+        self.assertFalse('aa' in self.raw)
+        self.assertEqual(None, self.store.pop('aa', None))
+        self.assertEqual(['bb', 'cc'], sorted(self.store.keys()))
+
+
+    def test_get_many(self):
+        signed_hash = transaction.Transaction(signed_blob).hash()
+        self.raw[signed_hash] = signed_blob
+        txs = self.store.get_many([signed_hash, 'aa', 'cc'])
+        self.assertEqual(signed_blob, txs[0].raw)
+        # 'aa' does not match its hash, 'cc' is not stored
+        self.assertEqual([None, None], txs[1:])
+        self.assertTrue(txs[0] is self.store.get(signed_hash))
+
+
+class TestParseTransactions(unittest.TestCase):
+
+    def check(self, processes):
+        signed_hash = transaction.Transaction(signed_blob).hash()
+        n = transaction.BULK_PARSE_MIN
+        items = [(signed_hash, signed_blob), (None, unsigned_blob),
+                 (None, 'beef'), ('00' * 32, signed_blob)] * n
+        txs = transaction.parse_transactions(items, processes)
+        self.assertEqual(4 * n, len(txs))
+        for i in range(0, 4 * n, 4):
+            self.assertEqual(signed_blob, txs[i].raw)
+            self.assertEqual('1446oU3z268EeFgfcwJv6X2VBXHfoYxfuD', txs[i].inputs()[0]['address'])
+            self.assertEqual([(TYPE_ADDRESS, '14CHYaaByjJZpx4oHBpfDMdqhTyXnZ3kVs', 1000000)], txs[i].outputs())
+            self.assertEqual(signed_blob, txs[i].serialize())
+            self.assertEqual(unsigned_blob, txs[i + 1].serialize())
+            self.assertEqual([None, None], txs[i + 2:i + 4])
+
+    def test_serial(self):
+        self.check(1)
+
+    def test_process_pool(self):
+        self.check(2)
+
+
+class TestSighashes(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSighashes, self).setUp()
+        self.keypairs = {}
+        inputs = []
+        for i in range(5):
+            sec = bitcoin.SecretToASecret(bitcoin.Hash('key %d' % i), True)
+            pubkey = bitcoin.public_key_from_private_key(sec)
+            self.keypairs[pubkey] = sec
+            inputs.append({
+                'prevout_hash': bitcoin.Hash('tx %d' % i).encode('hex'),
+                'prevout_n': i,
+                'address': bitcoin.public_key_to_bc_address(pubkey.decode('hex')),
+                'x_pubkeys': [pubkey],
+                'pubkeys': [pubkey],
+                'signatures': [None],
+                'num_sig': 1,
+                'value': 100000,
+            })
+        outputs = [(TYPE_ADDRESS, inputs[0]['address'], 300000)]
+        self.tx = transaction.Transaction.from_io(inputs, outputs)
+
+    def test_sighashes(self):
+        expected = [bitcoin.Hash(self.tx.tx_for_sig(i).decode('hex')) for i in range(5)]
+        self.assertEqual(dict(enumerate(expected)), self.tx.sighashes(range(5)))
+        self.assertEqual({3: expected[3]}, self.tx.sighashes([3]))
+
+    def test_sign(self):
+        del self.keypairs[self.tx.inputs()[1]['x_pubkeys'][0]]
+        sighashes = self.tx.sighashes(range(5))
+        self.tx.sign(self.keypairs)
+        for i, txin in enumerate(self.tx.inputs()):
+            sig = txin['signatures'][0]
+            if i == 1:
+                self.assertEqual(None, sig)
+                continue
+            r, s = ecdsa.util.sigdecode_der(sig.decode('hex'), bitcoin.ecc.N)
+            sig_string = ecdsa.util.sigencode_string(r, s, bitcoin.ecc.N)
+            self.assertTrue(bitcoin.get_ec_backend().verify(sighashes[i], sig_string, txin['pubkeys'][0].decode('hex')))
+        self.assertFalse(self.tx.is_complete())
+
+
+class TestUpdateSignatures(unittest.TestCase):
+
+    def setUp(self):
+        super(TestUpdateSignatures, self).setUp()
+        self.secs = [bitcoin.SecretToASecret(bitcoin.Hash('key %d' % i), True) for i in range(3)]
+        self.pubkeys = [bitcoin.public_key_from_private_key(sec) for sec in self.secs]
+        self.address = bitcoin.public_key_to_bc_address(self.pubkeys[0].decode('hex'))
+
+    def make_tx(self, txin):
+        txin.update({'prevout_hash': bitcoin.Hash('tx').encode('hex'), 'prevout_n': 0, 'value': 100000})
+        return transaction.Transaction.from_io([txin], [(TYPE_ADDRESS, self.address, 90000)])
+
+    def multisig_tx(self):
+        redeem_script = transaction.Transaction.multisig_script(self.pubkeys, 2)
+        return self.make_tx({
+            'address': bitcoin.hash_160_to_bc_address(bitcoin.hash_160(redeem_script.decode('hex')), 5),
+            'redeemScript': redeem_script,
+            'x_pubkeys': list(self.pubkeys),
+            'pubkeys': list(self.pubkeys),
+            'signatures': [None] * 3,
+            'num_sig': 2,
+        })
+
+    def test_merge_multisig(self):
+        tx1 = self.multisig_tx()
+        tx1.sign({self.pubkeys[2]: self.secs[2]})
+        tx2 = self.multisig_tx()
+        tx2.sign({self.pubkeys[0]: self.secs[0]})
+        tx1.update_signatures(tx2.raw)
+        self.assertTrue(tx1.is_complete())
+        sigs = tx1.inputs()[0]['signatures']
+        self.assertEqual(tx2.inputs()[0]['signatures'][0], sigs[0])
+        self.assertEqual(None, sigs[1])
+
+    def test_bad_signature_is_ignored(self):
+        tx1 = self.multisig_tx()
+        tx2 = self.make_tx({
+            'address': self.address,
+            'x_pubkeys': [self.pubkeys[0]],
+            'pubkeys': [self.pubkeys[0]],
+            'signatures': [None],
+            'num_sig': 1,
+        })
+        tx2.sign({self.pubkeys[0]: self.secs[0]})
+        # same key, but the sighash of a different script
+        tx1.update_signatures(tx2.raw)
+        self.assertEqual([None, None, None], tx1.inputs()[0]['signatures'])
+
+    def test_unknown_pubkey_is_recovered(self):
+        addrtype, h160 = bitcoin.bc_address_to_hash_160(self.address)
+        x_pubkey = 'fd' + (chr(addrtype) + h160).encode('hex')
+        def unsigned():
+            return self.make_tx({
+                'address': self.address,
+                'x_pubkeys': [x_pubkey],
+                'pubkeys': [None],
+                'signatures': [None],
+                'num_sig': 1,
+            })
+        tx1 = unsigned()
+        tx2 = unsigned()
+        tx2.sign({x_pubkey: self.secs[0]})
+        tx1.update_signatures(tx2.raw)
+        self.assertTrue(tx1.is_complete())
+        self.assertEqual(tx2.raw, tx1.raw)
+
+
+class TestEstimatedSize(unittest.TestCase):
+
+    def setUp(self):
+        super(TestEstimatedSize, self).setUp()
+        secs = [bitcoin.Hash('key %d' % i) for i in range(15)]
+        self.pubkeys = [bitcoin.get_ec_backend().pubkey_from_secret(sec).encode('hex') for sec in secs]
+        self.uncompressed = bitcoin.get_ec_backend().pubkey_from_secret(secs[0], False).encode('hex')
+        self.address = bitcoin.public_key_to_bc_address(self.pubkeys[0].decode('hex'))
+
+    def p2pkh(self, pubkey):
+        return {'address': self.address, 'x_pubkeys': [pubkey], 'pubkeys': [pubkey],
+                'signatures': [None], 'num_sig': 1}
+
+    def multisig(self, m, n):
+        pubkeys = self.pubkeys[:n]
+        redeem_script = transaction.Transaction.multisig_script(pubkeys, m)
+        return {'address': bitcoin.hash_160_to_bc_address(bitcoin.hash_160(redeem_script.decode('hex')), 5),
+                'redeemScript': redeem_script, 'x_pubkeys': pubkeys, 'pubkeys': pubkeys,
+                'signatures': [None] * n, 'num_sig': m}
+
+    def check(self, inputs, outputs):
+        for i, txin in enumerate(inputs):
+            txin.update({'prevout_hash': bitcoin.Hash('tx %d' % i).encode('hex'), 'prevout_n': i, 'value': 1000})
+            self.assertEqual(len(transaction.Transaction.serialize_input(txin, -1, -1)) / 2,
+                             transaction.Transaction.estimated_input_size(txin))
+        tx = transaction.Transaction.from_io(inputs, outputs)
+        self.assertEqual(len(tx.serialize(-1)) / 2, tx.estimated_size())
+        self.assertEqual(tx.estimated_size(), transaction.Transaction.estimated_tx_size(inputs, outputs))
+
+    def test_input_types(self):
+        addrtype, h160 = bitcoin.bc_address_to_hash_160(self.address)
+        unknown = self.p2pkh(None)
+        unknown['x_pubkeys'] = ['fd' + (chr(addrtype) + h160).encode('hex')]
+        inputs = [self.p2pkh(self.pubkeys[0]), self.p2pkh(self.uncompressed), unknown,
+                  self.multisig(1, 1), self.multisig(2, 3), self.multisig(7, 15), self.multisig(15, 15)]
+        self.check(inputs, [(TYPE_ADDRESS, self.address, 1000)])
+
+    def test_output_types(self):
+        p2sh = self.multisig(2, 3)['address']
+        outputs = [(TYPE_ADDRESS, self.address, 1), (TYPE_ADDRESS, p2sh, 2),
+                   (bitcoin.TYPE_SCRIPT, '\x6a\x04test', 0), (bitcoin.TYPE_SCRIPT, '\x6a' * 300, 0)]
+        self.check([self.p2pkh(self.pubkeys[0])], outputs)
+        self.check([], outputs)
+
+    def test_many_inputs_and_outputs(self):
+        inputs = [self.p2pkh(self.pubkeys[0]) for i in range(0xfd)]
+        outputs = [(TYPE_ADDRESS, self.address, i) for i in range(0xfd)]
+        self.check(inputs, outputs)
+
+
 class NetworkMock(object):
 
     def __init__(self, unspent):
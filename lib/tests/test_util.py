@@ -1,5 +1,9 @@
+import json
+import select
+import socket
+import threading
 import unittest
-from lib.util import format_satoshis, parse_URI
+from lib.util import format_satoshis, parse_URI, Wakeup, SocketPipe
 
 class TestUtil(unittest.TestCase):
 
@@ -68,3 +72,58 @@ class TestUtil(unittest.TestCase):
     def test_parse_URI_parameter_polution(self):
         self.assertRaises(Exception, parse_URI, 'bitcoin:15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma?amount=0.0003&label=test&amount=30.0')
 
+
+class TestWakeup(unittest.TestCase):
+
+    def test_set_and_clear(self):
+        wakeup = Wakeup()
+        try:
+            self.assertEqual([], select.select([wakeup], [], [], 0)[0])
+            wakeup.set()
+            wakeup.set()
+            self.assertEqual([wakeup], select.select([wakeup], [], [], 0)[0])
+            wakeup.clear()
+            self.assertEqual([], select.select([wakeup], [], [], 0)[0])
+            wakeup.set()
+            self.assertEqual([wakeup], select.select([wakeup], [], [], 0)[0])
+        finally:
+            wakeup.close()
+
+
+class TestSocketPipe(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSocketPipe, self).setUp()
+        self.a, self.b = socket.socketpair()
+        self.pipe = SocketPipe(self.b)
+        self.pipe.set_timeout(None)
+
+    def tearDown(self):
+        super(TestSocketPipe, self).tearDown()
+        self.a.close()
+        self.b.close()
+
+    def test_framing(self):
+        big = {'id': 2, 'result': 'ab' * 200000}
+        data = '{"id": 1}\nnot json\nnull\n' + json.dumps(big) + '\n[1, 2]\n{"id"'
+        def write():
+            # in pieces that split messages
+            for i in range(0, len(data), 70000):
+                self.a.sendall(data[i:i + 70000])
+            self.a.sendall(': 3}\n')
+            self.a.shutdown(socket.SHUT_WR)
+        t = threading.Thread(target=write)
+        t.start()
+        self.assertEqual({'id': 1}, self.pipe.get())
+        self.assertEqual(big, self.pipe.get())
+        self.assertEqual([1, 2], self.pipe.get())
+        self.assertEqual({'id': 3}, self.pipe.get())
+        self.assertEqual(None, self.pipe.get())
+        t.join()
+
+    def test_send_all(self):
+        requests = [{'id': i, 'method': 'server.version'} for i in range(3)]
+        self.pipe.send_all(requests)
+        pipe = SocketPipe(self.a)
+        pipe.set_timeout(None)
+        self.assertEqual(requests, [pipe.get() for i in range(3)])
@@ -39,30 +39,188 @@ import struct
 # Workalike python implementation of Bitcoin's CDataStream class.
 #
 import struct
+import binascii
 import StringIO
 import random
+import threading
+import multiprocessing
+from collections import OrderedDict, namedtuple
 from keystore import xpubkey_to_address
 
 NO_SIGNATURE = 'ff'
 
+# number of parsed transactions kept by a TransactionStore
+TX_CACHE_SIZE = 1000
+
+# batches of at least this many transactions are parsed in a process pool
+BULK_PARSE_MIN = 200
+
 
 class SerializationError(Exception):
     """ Thrown when there's a problem deserializing or serializing """
 
+class TxInput(object):
+    '''A transaction input.  The usual fields are kept in slots rather
+    than in a dict per input, but the dict interface is kept, so that
+    txin['address'], txin.get(...) and the like keep working.  An unset
+    slot is a missing key; other keys go to a dict that is only created
+    when needed.'''
+
+    __slots__ = ['prevout_hash', 'prevout_n', 'sequence', 'scriptSig',
+                 'is_coinbase', 'address', 'num_sig', 'x_pubkeys',
+                 'pubkeys', 'signatures', 'redeemScript', 'value', 'extra']
+    fields = __slots__[:-1]
+    field_set = frozenset(fields)
+    __hash__ = None
+
+    def __init__(self, *args, **kwargs):
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        try:
+            if key in self.field_set:
+                return getattr(self, key)
+            return self.extra[key]
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.field_set:
+            setattr(self, key, value)
+        else:
+            try:
+                self.extra[key] = value
+            except AttributeError:
+                self.extra = {key: value}
+
+    def __delitem__(self, key):
+        try:
+            if key in self.field_set:
+                delattr(self, key)
+            else:
+                del self.extra[key]
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def keys(self):
+        keys = [k for k in self.fields if hasattr(self, k)]
+        try:
+            keys.extend(self.extra.keys())
+        except AttributeError:
+            pass
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default
+            return default
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def update(self, other=(), **kwargs):
+        if hasattr(other, 'keys'):
+            other = [(k, other[k]) for k in other.keys()]
+        for k, v in other:
+            self[k] = v
+        for k, v in kwargs.items():
+            self[k] = v
+
+    def copy(self):
+        return TxInput(self)
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.update(state)
+
+    def __eq__(self, other):
+        if not hasattr(other, 'keys'):
+            return NotImplemented
+        return self.to_dict() == dict((k, other[k]) for k in other.keys())
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    def __repr__(self):
+        return 'TxInput(%r)' % self.to_dict()
+
+
+TxOutput = namedtuple('TxOutput', ['type', 'address', 'value'])
+
+
+# precompiled struct formats of BCDataStream
+structs = dict((f, struct.Struct(f)) for f in ['<h', '<H', '<i', '<I', '<q', '<Q'])
+
+
 class BCDataStream(object):
-    def __init__(self):
-        self.input = None
-        self.read_cursor = 0
+    '''Binary stream.  Writes are appended to a bytearray, and hex
+    conversion is left to callers.  Reads slice a str snapshot of the
+    data, taken after the last write; data passed to the constructor
+    is read in place.'''
+
+    def __init__(self, data=None):
+        self.clear()
+        self.buffer = data
 
     def clear(self):
-        self.input = None
+        self.buffer = None
+        self.view = None
         self.read_cursor = 0
 
+    @property
+    def input(self):
+        return None if self.buffer is None else str(self.buffer)
+
+    def get_view(self):
+        if self.view is None:
+            self.view = self.buffer if type(self.buffer) is str else str(self.buffer)
+        return self.view
+
     def write(self, bytes):  # Initialize with string of bytes
-        if self.input is None:
-            self.input = bytes
-        else:
-            self.input += bytes
+        self.view = None
+        if type(self.buffer) is not bytearray:
+            self.buffer = bytearray(self.buffer or '')
+        self.buffer += bytes
 
     def read_string(self):
         # Strings are encoded depending on length:
@@ -72,7 +230,7 @@ class BCDataStream(object):
         # ... and the Bitcoin client is coded to understand:
         # greater than 4,294,967,295 : byte '255' 8-byte-length followed by bytes of string
         # ... but I don't think it actually handles any strings that big.
-        if self.input is None:
+        if self.buffer is None:
             raise SerializationError("call write(bytes) before trying to deserialize")
 
         try:
@@ -88,14 +246,9 @@ class BCDataStream(object):
         self.write(string)
 
     def read_bytes(self, length):
-        try:
-            result = self.input[self.read_cursor:self.read_cursor+length]
-            self.read_cursor += length
-            return result
-        except IndexError:
-            raise SerializationError("attempt to read past end of buffer")
-
-        return ''
+        result = self.get_view()[self.read_cursor:self.read_cursor+length]
+        self.read_cursor += length
+        return result
 
     def read_boolean(self): return self.read_bytes(1)[0] != chr(0)
     def read_int16(self): return self._read_num('<h')
@@ -114,7 +267,7 @@ class BCDataStream(object):
     def write_uint64(self, val): return self._write_num('<Q', val)
 
     def read_compact_size(self):
-        size = ord(self.input[self.read_cursor])
+        size = ord(self.get_view()[self.read_cursor])
         self.read_cursor += 1
         if size == 253:
             size = self._read_num('<H')
@@ -140,13 +293,13 @@ class BCDataStream(object):
             self._write_num('<Q', size)
 
     def _read_num(self, format):
-        (i,) = struct.unpack_from(format, self.input, self.read_cursor)
-        self.read_cursor += struct.calcsize(format)
+        s = structs[format]
+        (i,) = s.unpack_from(self.get_view(), self.read_cursor)
+        self.read_cursor += s.size
         return i
 
     def _write_num(self, format, num):
-        s = struct.pack(format, num)
-        self.write(s)
+        self.write(structs[format].pack(num))
 
 #
 # enum-like type
@@ -391,11 +544,11 @@ def get_address_from_output_script(bytes):
 
 
 def parse_input(vds):
-    d = {}
-    prevout_hash = hash_encode(vds.read_bytes(32))
+    d = TxInput()
+    prevout_hash = binascii.hexlify(vds.read_bytes(32)[::-1])
     prevout_n = vds.read_uint32()
     scriptSig = vds.read_bytes(vds.read_compact_size())
-    d['scriptSig'] = scriptSig.encode('hex')
+    d['scriptSig'] = binascii.hexlify(scriptSig)
     sequence = vds.read_uint32()
     if prevout_hash == '00'*32:
         d['is_coinbase'] = True
@@ -417,14 +570,13 @@ def parse_output(vds, i):
     d['value'] = vds.read_int64()
     scriptPubKey = vds.read_bytes(vds.read_compact_size())
     d['type'], d['address'] = get_address_from_output_script(scriptPubKey)
-    d['scriptPubKey'] = scriptPubKey.encode('hex')
+    d['scriptPubKey'] = binascii.hexlify(scriptPubKey)
     d['prevout_n'] = i
     return d
 
 
 def deserialize(raw):
-    vds = BCDataStream()
-    vds.write(raw.decode('hex'))
+    vds = BCDataStream(raw.decode('hex'))
     d = {}
     start = vds.read_cursor
     d['version'] = vds.read_int32()
@@ -478,32 +630,59 @@ class Transaction:
     def update_signatures(self, raw):
         """Add new signatures to a transaction"""
         d = deserialize(raw)
+        new_sigs = []
         for i, txin in enumerate(self.inputs()):
             sigs1 = txin.get('signatures')
             sigs2 = d['inputs'][i].get('signatures')
-            for sig in sigs2:
+            for k, sig in enumerate(sigs2):
                 if sig in sigs1:
                     continue
-                for_sig = Hash(self.tx_for_sig(i).decode('hex'))
-                # der to string
-                order = ecdsa.ecdsa.generator_secp256k1.order()
-                r, s = ecdsa.util.sigdecode_der(sig.decode('hex'), order)
-                sig_string = ecdsa.util.sigencode_string(r, s, order)
-                pubkeys = txin.get('pubkeys')
-                compressed = True
-                for recid in range(4):
-                    public_key = MyVerifyingKey.from_signature(sig_string, recid, for_sig, curve = SECP256k1)
-                    pubkey = point_to_ser(public_key.pubkey.point, compressed).encode('hex')
-                    if pubkey in pubkeys:
-                        public_key.verify_digest(sig_string, for_sig, sigdecode = ecdsa.util.sigdecode_string)
-                        j = pubkeys.index(pubkey)
-                        print_error("adding sig", i, j, pubkey, sig)
-                        self._inputs[i]['signatures'][j] = sig
-                        self._inputs[i]['x_pubkeys'][j] = pubkey
-                        break
+                new_sigs.append((i, k, sig))
+        sighashes = self.sighashes(set(i for i, k, sig in new_sigs))
+        order = ecdsa.ecdsa.generator_secp256k1.order()
+        for i, k, sig in new_sigs:
+            # der to string
+            r, s = ecdsa.util.sigdecode_der(sig.decode('hex'), order)
+            sig_string = ecdsa.util.sigencode_string(r, s, order)
+            txin = self._inputs[i]
+            j, pubkey = self.match_signature(txin, sighashes[i], sig_string, k)
+            if j is None:
+                print_error("signature does not match", i, sig)
+                continue
+            print_error("adding sig", i, j, pubkey, sig)
+            txin['signatures'][j] = sig
+            txin['x_pubkeys'][j] = pubkey
+            txin['pubkeys'][j] = pubkey
         # redo raw
         self.raw = self.serialize()
 
+    @classmethod
+    def match_signature(self, txin, sighash, sig_string, hint):
+        """Return the index and the pubkey of txin that made a
+        signature, or (None, None).  Known pubkeys are verified
+        directly, starting with the one at the position of the
+        signature in the other tx (hint).  Pubkey recovery is only
+        used for inputs with an unknown pubkey."""
+        backend = get_ec_backend()
+        pubkeys = txin['pubkeys']
+        for j in sorted(range(len(pubkeys)), key=lambda j: j != hint):
+            if pubkeys[j] is None or txin['signatures'][j] is not None:
+                continue
+            try:
+                pubkey = pubkeys[j].decode('hex')
+            except TypeError:
+                continue
+            if backend.verify(sighash, sig_string, pubkey):
+                return j, pubkeys[j]
+        if None in pubkeys:
+            j = pubkeys.index(None)
+            for recid in range(4):
+                for compressed in [True, False]:
+                    pubkey = backend.recover(sighash, sig_string, recid, compressed)
+                    if pubkey and public_key_to_bc_address(pubkey) == txin['address']:
+                        return j, pubkey.encode('hex')
+        return None, None
+
 
     def deserialize(self):
         if self.raw is None:
@@ -512,10 +691,18 @@ class Transaction:
             return
         d = deserialize(self.raw)
         self._inputs = d['inputs']
-        self._outputs = [(x['type'], x['address'], x['value']) for x in d['outputs']]
+        self._outputs = [TxOutput(x['type'], x['address'], x['value']) for x in d['outputs']]
         self.locktime = d['lockTime']
         return d
 
+    @classmethod
+    def from_parsed(klass, raw, inputs, outputs, locktime):
+        self = klass(raw)
+        self._inputs = inputs
+        self._outputs = outputs
+        self.locktime = locktime
+        return self
+
     @classmethod
     def from_io(klass, inputs, outputs, locktime=0):
         self = klass(None)
@@ -633,16 +820,21 @@ class Transaction:
         return script
 
     @classmethod
-    def serialize_input(self, txin, i, for_sig):
+    def write_input(self, vds, txin, i, for_sig, script=None):
         # Prev hash and index
-        s = txin['prevout_hash'].decode('hex')[::-1].encode('hex')
-        s += int_to_hex(txin['prevout_n'], 4)
+        vds.write(txin['prevout_hash'].decode('hex')[::-1])
+        vds.write_uint32(txin['prevout_n'])
         # Script length, script, sequence
-        script = self.input_script(txin, i, for_sig)
-        s += var_int(len(script)/2)
-        s += script
-        s += int_to_hex(txin.get('sequence', 0xffffffff), 4)
-        return s
+        if script is None:
+            script = self.input_script(txin, i, for_sig)
+        vds.write_string(script.decode('hex'))
+        vds.write_uint32(txin.get('sequence', 0xffffffff))
+
+    @classmethod
+    def serialize_input(self, txin, i, for_sig, script=None):
+        vds = BCDataStream()
+        self.write_input(vds, txin, i, for_sig, script)
+        return binascii.hexlify(vds.buffer)
 
     def set_sequence(self, n):
         for txin in self.inputs():
@@ -655,26 +847,63 @@ class Transaction:
 
     def serialize(self, for_sig=None):
         inputs = self.inputs()
-        outputs = self.outputs()
-        s = int_to_hex(1, 4)                                         # version
-        s += var_int(len(inputs))                                    # number of inputs
+        vds = BCDataStream()
+        vds.write_int32(1)                                           # version
+        vds.write_compact_size(len(inputs))                          # number of inputs
         for i, txin in enumerate(inputs):
-            s += self.serialize_input(txin, i, for_sig)
-        s += var_int(len(outputs))                                   # number of outputs
-        for output in outputs:
-            output_type, addr, amount = output
-            s += int_to_hex(amount, 8)                               # amount
-            script = self.pay_script(output_type, addr)
-            s += var_int(len(script)/2)                              #  script length
-            s += script                                              #  script
-        s += int_to_hex(self.locktime, 4)                            #  locktime
+            self.write_input(vds, txin, i, for_sig)
+        self.write_outputs(vds)
+        vds.write_uint32(self.locktime)                              # locktime
         if for_sig is not None and for_sig != -1:
-            s += int_to_hex(1, 4)                                    #  hash type
-        return s
+            vds.write_uint32(1)                                      # hash type
+        return binascii.hexlify(vds.buffer)
+
+    def write_outputs(self, vds):
+        outputs = self.outputs()
+        vds.write_compact_size(len(outputs))                         # number of outputs
+        for output_type, addr, amount in outputs:
+            vds.write_int64(amount)                                  # amount
+            script = self.pay_script(output_type, addr)
+            vds.write_string(script.decode('hex'))                   # script
 
     def tx_for_sig(self,i):
         return self.serialize(for_sig = i)
 
+    def sighashes(self, indexes):
+        '''Return a dict of Hash(self.tx_for_sig(i)) for i in indexes.
+
+        The preimages only differ by the script of the signed input.
+        Every other part is serialized once, the hash state of the
+        common prefix is carried from one input to the next, and the
+        suffix is hashed from a single buffer.'''
+        inputs = self.inputs()
+        indexes = set(indexes)
+        # blanked inputs, outputs, locktime and hash type
+        vds = BCDataStream()
+        offsets = [0]
+        for j, txin in enumerate(inputs):
+            self.write_input(vds, txin, j, None, '')
+            offsets.append(len(vds.buffer))
+        self.write_outputs(vds)
+        vds.write_uint32(self.locktime)
+        vds.write_uint32(1)
+        tail = memoryview(vds.buffer)
+        header = BCDataStream()
+        header.write_int32(1)
+        header.write_compact_size(len(inputs))
+        prefix = hashlib.sha256(header.buffer)
+        out = {}
+        for i, txin in enumerate(inputs):
+            if i in indexes:
+                signed = BCDataStream()
+                self.write_input(signed, txin, i, i)
+                h = prefix.copy()
+                h.update(signed.buffer)
+                h.update(tail[offsets[i+1]:])
+                out[i] = hashlib.sha256(h.digest()).digest()
+            prefix.update(tail[offsets[i]:offsets[i+1]])
+        return out
+
     def hash(self):
         return Hash(self.raw.decode('hex'))[::-1].encode('hex')
 
@@ -698,15 +927,50 @@ class Transaction:
     def is_final(self):
         return not any([x.get('sequence', 0xffffffff) < 0xffffffff - 1 for x in self.inputs()])
 
-    @profiler
     def estimated_size(self):
         '''Return an estimated tx size in bytes.'''
-        return len(self.serialize(-1)) / 2  # ASCII hex string
+        return self.estimated_tx_size(self.inputs(), self.outputs())
+
+    # The estimates below are computed from the script types, and are
+    # equal to the size of serialize(-1), without serializing.
+
+    @classmethod
+    def estimated_tx_size(self, inputs, outputs):
+        '''Return the estimated size in bytes of a tx with inputs and
+        outputs.'''
+        return (4 + var_int_size(len(inputs))
+                + sum(self.estimated_input_size(txin) for txin in inputs)
+                + var_int_size(len(outputs))
+                + sum(self.estimated_output_size(o) for o in outputs)
+                + 4)
 
     @classmethod
     def estimated_input_size(self, txin):
         '''Return an estimated of serialized input size in bytes.'''
-        return len(self.serialize_input(txin, -1, -1)) / 2
+        script_size = self.estimated_input_script_size(txin)
+        return 32 + 4 + var_int_size(script_size) + script_size + 4
+
+    @classmethod
+    def estimated_input_script_size(self, txin):
+        # see input_script(txin, -1, -1): dummy 0x48 bytes signatures
+        p2sh = txin.get('redeemScript') is not None
+        num_sig = txin['num_sig'] if p2sh else 1
+        size = num_sig * (op_push_size(0x48) + 0x48)
+        pubkeys = txin['pubkeys']
+        if not p2sh:
+            # an unknown pubkey is serialized as 'fd' + address
+            n = len(pubkeys[0]) / 2 if pubkeys[0] is not None else 22
+            size += op_push_size(n) + n
+        else:
+            redeem_script_size = 3 + sum(op_push_size(len(k)/2) + len(k)/2 for k in pubkeys)
+            size += 1 + op_push_size(redeem_script_size) + redeem_script_size
+        return size
+
+    @classmethod
+    def estimated_output_size(self, output):
+        output_type, addr, amount = output
+        script_size = len(self.pay_script(output_type, addr)) / 2
+        return 8 + var_int_size(script_size) + script_size
 
     def signature_count(self):
         r = 0
@@ -732,6 +996,10 @@ class Transaction:
 
 
     def sign(self, keypairs):
+        to_sign = [i for i, txin in enumerate(self.inputs())
+                   if len(filter(None, txin['signatures'])) < txin['num_sig']
+                   and any(x_pubkey in keypairs for x_pubkey in txin['x_pubkeys'])]
+        sighashes = self.sighashes(to_sign)
         for i, txin in enumerate(self.inputs()):
             num = txin['num_sig']
             for x_pubkey in txin['x_pubkeys']:
@@ -739,25 +1007,27 @@ class Transaction:
                 if len(signatures) == num:
                     # txin is complete
                     break
-                if x_pubkey in keypairs.keys():
+                if x_pubkey in keypairs:
                     print_error("adding signature for", x_pubkey)
                     # add pubkey to txin
                     txin = self._inputs[i]
                     x_pubkeys = txin['x_pubkeys']
                     ii = x_pubkeys.index(x_pubkey)
                     sec = keypairs[x_pubkey]
-                    pubkey = public_key_from_private_key(sec)
+                    secret = ASecretToSecret(sec)
+                    assert secret
+                    backend = get_ec_backend()
+                    pubkey = backend.pubkey_from_secret(secret[0:32], len(secret) == 33).encode('hex')
                     txin['x_pubkeys'][ii] = pubkey
                     txin['pubkeys'][ii] = pubkey
                     self._inputs[i] = txin
                     # add signature
-                    for_sig = Hash(self.tx_for_sig(i).decode('hex'))
-                    pkey = regenerate_key(sec)
-                    secexp = pkey.secret
-                    private_key = bitcoin.MySigningKey.from_secret_exponent( secexp, curve = SECP256k1 )
-                    public_key = private_key.get_verifying_key()
-                    sig = private_key.sign_digest_deterministic( for_sig, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_der )
-                    assert public_key.verify_digest( sig, for_sig, sigdecode = ecdsa.util.sigdecode_der)
+                    for_sig = sighashes[i]
+                    sig_string = backend.sign(for_sig, secret[0:32])
+                    assert backend.verify(for_sig, sig_string, pubkey.decode('hex'))
+                    order = ecdsa.ecdsa.generator_secp256k1.order()
+                    r, s = ecdsa.util.sigdecode_string(sig_string, order)
+                    sig = ecdsa.util.sigencode_der(r, s, order)
                     txin['signatures'][ii] = sig.encode('hex')
                     self._inputs[i] = txin
         print_error("is_complete", self.is_complete())
@@ -820,6 +1090,132 @@ class Transaction:
 
 
 
+class TransactionStore(object):
+    """The transactions of a wallet, by hash.  Transactions are kept
+    as raw hex strings (shared with the wallet storage), and parsed on
+    demand; only the most recently used parsed transactions are kept."""
+
+    def __init__(self, raw=None, cache_size=TX_CACHE_SIZE):
+        self.raw = raw if raw is not None else {}
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.raw
+
+    def __iter__(self):
+        return iter(self.raw.keys())
+
+    def keys(self):
+        return self.raw.keys()
+
+    def get_raw(self, tx_hash):
+        return self.raw.get(tx_hash)
+
+    def get(self, tx_hash, default=None):
+        with self.lock:
+            tx = self.cache.pop(tx_hash, None)
+            if tx is None:
+                raw = self.raw.get(tx_hash)
+                if raw is None:
+                    return default
+                tx = Transaction(raw)
+            self.add_to_cache(tx_hash, tx)
+        return tx
+
+    def get_many(self, tx_hashes):
+        '''Like get() for a list of hashes.  The transactions that are
+        not cached are parsed with parse_transactions(), and checked
+        against their hash; None is returned for those that fail.'''
+        with self.lock:
+            txs = [self.cache.get(tx_hash) for tx_hash in tx_hashes]
+            todo = [(tx_hash, self.raw[tx_hash]) for tx_hash, tx in zip(tx_hashes, txs)
+                    if tx is None and tx_hash in self.raw]
+        parsed = dict(zip([tx_hash for tx_hash, raw in todo], parse_transactions(todo)))
+        with self.lock:
+            for i, tx_hash in enumerate(tx_hashes):
+                tx = txs[i] if txs[i] is not None else parsed.get(tx_hash)
+                if tx is not None:
+                    self.cache.pop(tx_hash, None)
+                    self.add_to_cache(tx_hash, tx)
+                txs[i] = tx
+        return txs
+
+    def __getitem__(self, tx_hash):
+        tx = self.get(tx_hash)
+        if tx is None:
+            raise KeyError(tx_hash)
+        return tx
+
+    def __setitem__(self, tx_hash, tx):
+        with self.lock:
+            self.raw[tx_hash] = str(tx)
+            self.cache.pop(tx_hash, None)
+            self.add_to_cache(tx_hash, tx)
+
+    def add_to_cache(self, tx_hash, tx):
+        self.cache[tx_hash] = tx
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def pop(self, tx_hash, *default):
+        with self.lock:
+            tx = self.cache.pop(tx_hash, None)
+            raw = self.raw.pop(tx_hash, None)
+        if raw is None:
+            if default:
+                return default[0]
+            raise KeyError(tx_hash)
+        return tx if tx is not None else Transaction(raw)
+
+
+def _parse_raw_tx(item):
+    # runs in the worker processes of parse_transactions
+    tx_hash, raw = item
+    try:
+        if tx_hash is not None and hash_encode(Hash(raw.decode('hex'))) != tx_hash:
+            return None
+        d = deserialize(raw)
+    except Exception:
+        return None
+    outputs = [TxOutput(x['type'], x['address'], x['value']) for x in d['outputs']]
+    return d['inputs'], outputs, d['lockTime']
+
+
+def parse_transactions(items, processes=None):
+    '''Parse a list of (tx_hash, raw) pairs.  Return the list of parsed
+    Transactions, in the same order; an entry is None if the raw tx
+    cannot be parsed, or does not hash to tx_hash (pass None as tx_hash
+    to skip that check).  Large batches are spread over a pool of
+    worker processes.'''
+    items = list(items)
+    pool = None
+    if len(items) >= BULK_PARSE_MIN:
+        try:
+            if processes is None:
+                processes = multiprocessing.cpu_count()
+            if processes > 1:
+                pool = multiprocessing.Pool(processes)
+        except (ImportError, NotImplementedError, OSError) as e:
+            # no working multiprocessing on this platform (e.g. Android)
+            print_error("parse_transactions: no process pool:", e)
+    if pool is not None:
+        try:
+            chunksize = max(1, len(items) / (4 * processes))
+            parsed = pool.map(_parse_raw_tx, items, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        parsed = map(_parse_raw_tx, items)
+    return [Transaction.from_parsed(raw, *p) if p is not None else None
+            for (tx_hash, raw), p in zip(items, parsed)]
+
+
 def tx_from_str(txt):
     "json or raw hexadecimal"
     import json
@@ -26,7 +26,7 @@
 import os, sys, re, json
 import platform
 import shutil
-from collections import defaultdict
+from collections import defaultdict, deque
 from datetime import datetime
 from decimal import Decimal
 import traceback
@@ -55,9 +55,11 @@ class UserCancelled(Exception):
 
 class MyEncoder(json.JSONEncoder):
     def default(self, obj):
-        from transaction import Transaction
+        from transaction import Transaction, TxInput
         if isinstance(obj, Transaction):
             return obj.as_dict()
+        if isinstance(obj, TxInput):
+            return obj.to_dict()
         return super(MyEncoder, self).default(obj)
 
 class PrintError(object):
@@ -509,11 +511,66 @@ import json
 import ssl
 import time
 
+class Wakeup:
+    '''Wakes up a thread waiting in select() from other threads: add
+    the Wakeup to the read list, and it becomes readable when set() is
+    called, until clear().'''
+
+    def __init__(self):
+        try:
+            self.r, self.w = socket.socketpair()
+        except AttributeError:
+            # Windows: no socketpair, and select() only takes sockets
+            server = socket._socketobject()
+            server.bind(('127.0.0.1', 0))
+            server.listen(1)
+            self.w = socket._socketobject()
+            self.w.connect(server.getsockname())
+            self.r, _ = server.accept()
+            server.close()
+        self.r.setblocking(False)
+        self.w.setblocking(False)
+        self.lock = threading.Lock()
+        self.is_set = False
+
+    def fileno(self):
+        return self.r.fileno()
+
+    def set(self):
+        with self.lock:
+            if not self.is_set:
+                self.is_set = True
+                try:
+                    self.w.send('\0')
+                except socket.error:
+                    pass
+
+    def clear(self):
+        with self.lock:
+            if self.is_set:
+                self.is_set = False
+                try:
+                    self.r.recv(1024)
+                except socket.error:
+                    pass
+
+    def close(self):
+        self.r.close()
+        self.w.close()
+
+
 class SocketPipe:
 
+    # bytes read per recv()
+    RECV_SIZE = 65536
+
     def __init__(self, socket):
         self.socket = socket
-        self.message = ''
+        # received bytes not yet split into messages; none of the
+        # first scanned bytes is a newline
+        self.buffer = bytearray()
+        self.scanned = 0
+        self.messages = deque()
         self.set_timeout(0.1)
         self.recv_time = time.time()
 
@@ -525,11 +582,10 @@ class SocketPipe:
 
     def get(self):
         while True:
-            response, self.message = parse_json(self.message)
-            if response is not None:
-                return response
+            if self.messages:
+                return self.messages.popleft()
             try:
-                data = self.socket.recv(1024)
+                data = self.socket.recv(self.RECV_SIZE)
             except socket.timeout:
                 raise timeout
             except ssl.SSLError:
@@ -538,8 +594,7 @@ class SocketPipe:
                 if err.errno == 60:
                     raise timeout
                 elif err.errno in [11, 35, 10035]:
-                    print_error("socket errno %d (resource temporarily unavailable)"% err.errno)
-                    time.sleep(0.2)
+                    # non-blocking socket without data
                     raise timeout
                 else:
                     print_error("pipe: socket error", err)
@@ -550,8 +605,34 @@ class SocketPipe:
 
             if not data:  # Connection closed remotely
                 return None
-            self.message += data
+            self.buffer += data
             self.recv_time = time.time()
+            self.split_messages()
+
+    def split_messages(self):
+        '''Decode the complete lines of the buffer.  Only the bytes
+        received since the last call are scanned for a newline.'''
+        if self.buffer.find('\n', self.scanned) == -1:
+            self.scanned = len(self.buffer)
+            return
+        n = self.buffer.rfind('\n')
+        lines = str(self.buffer[:n])
+        del self.buffer[:n + 1]
+        self.scanned = len(self.buffer)
+        try:
+            # usually all of them at once
+            messages = json.loads('[' + lines.replace('\n', ',') + ']')
+            if len(messages) != lines.count('\n') + 1:
+                raise ValueError('not one message per line')
+        except Exception:
+            messages = []
+            for line in lines.split('\n'):
+                try:
+                    messages.append(json.loads(line))
+                except Exception:
+                    pass
+        # null and invalid lines are skipped, as before
+        self.messages.extend(m for m in messages if m is not None)
 
     def send(self, request):
         out = json.dumps(request) + '\n'
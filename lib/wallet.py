@@ -41,17 +41,18 @@ import json
 import copy
 import re
 import stat
+import bisect
 from functools import partial
-from collections import namedtuple, defaultdict
+from collections import namedtuple, defaultdict, OrderedDict
 
 from i18n import _
 from util import NotEnoughFunds, PrintError, profiler
 
 from bitcoin import *
 from version import *
-from keystore import load_keystore
+from keystore import load_keystore, UnlockedKeyStores
 
-from transaction import Transaction
+from transaction import Transaction, TransactionStore
 from plugins import run_hook
 import bitcoin
 import coinchooser
@@ -71,6 +72,72 @@ TX_STATUS = [
     _('Not Verified'),
 ]
 
+# transaction data received from the network is saved at most this often
+SAVE_INTERVAL = 10
+
+
+class HistoryIndex(object):
+    """The history of the whole wallet, as rows ordered by position in
+    the blockchain.  The wallet marks the transactions whose delta or
+    position may have changed, and their rows are recomputed on the
+    next read."""
+
+    def __init__(self, wallet):
+        self.wallet = wallet
+        self.lock = threading.Lock()
+        self.keys = []      # sorted (txpos, tx_hash)
+        self.rows = {}      # tx_hash -> (txpos, delta)
+        self.changed = set()
+        # sum of the known deltas, and number of unknown (pruned) ones
+        self.delta_sum = 0
+        self.unknown_deltas = 0
+
+    def mark(self, tx_hashes):
+        self.changed.update(tx_hashes)
+
+    def refresh(self):
+        while self.changed:
+            tx_hash = self.changed.pop()
+            row = self.rows.pop(tx_hash, None)
+            if row is not None:
+                txpos, delta = row
+                del self.keys[bisect.bisect_left(self.keys, (txpos, tx_hash))]
+                self.add_delta(delta, -1)
+            delta = self.wallet.get_wallet_tx_delta(tx_hash)
+            if delta is False:
+                continue
+            txpos = self.wallet.get_txpos(tx_hash)
+            self.rows[tx_hash] = txpos, delta
+            bisect.insort(self.keys, (txpos, tx_hash))
+            self.add_delta(delta, 1)
+
+    def add_delta(self, delta, sign):
+        if delta is None:
+            self.unknown_deltas += sign
+        else:
+            self.delta_sum += sign * delta
+
+    def get_rows(self, balance, offset=0, limit=None):
+        """Return (tx_hash, delta, balance) rows, newest first, after
+        skipping offset rows.  Only the rows read are visited."""
+        with self.lock:
+            self.refresh()
+            # fixme: this may happen if history is incomplete
+            if self.unknown_deltas == 0 and balance != self.delta_sum:
+                return None
+            stop = len(self.keys) if limit is None else min(len(self.keys), offset + limit)
+            out = []
+            for i in xrange(stop):
+                txpos, tx_hash = self.keys[-1 - i]
+                delta = self.rows[tx_hash][1]
+                if i >= offset:
+                    out.append((tx_hash, delta, balance))
+                if balance is None or delta is None:
+                    balance = None
+                else:
+                    balance -= delta
+            return out
+
 
 
 class Abstract_Wallet(PrintError):
@@ -96,7 +163,19 @@ class Abstract_Wallet(PrintError):
         self.labels                = storage.get('labels', {})
         self.frozen_addresses      = set(storage.get('frozen_addresses',[]))
         self.stored_height         = storage.get('stored_height', 0)       # last known height (for offline mode)
-        self.history               = storage.get('addr_history',{})        # address -> list(txid, height)
+        self.history               = storage.get_shared('addr_history',{}) # address -> list(txid, height)
+        # (storage key, item key) of the transaction data changed since
+        # the last save; save_transactions() writes these items only
+        self.changed_items = set()
+        # saves requested by network callbacks, are coalesced by
+        # save_pending_transactions(); both counters are for statistics
+        self.save_pending = False
+        self.last_save = 0
+        self.save_requests = 0
+        self.saves = 0
+        # address -> (utxos, balance, received, local height), see get_addr_cache
+        self.addr_cache = {}
+        self.addr_cache_gen = 0
 
         self.load_keystore()
         self.load_addresses()
@@ -111,7 +190,7 @@ class Abstract_Wallet(PrintError):
         self.unverified_tx = defaultdict(int)
 
         # Verified transactions.  Each value is a (height, timestamp, block_pos) tuple.  Access with self.lock.
-        self.verified_tx = storage.get('verified_tx3', {})
+        self.verified_tx = storage.get_shared('verified_tx3', {})
 
         # there is a difference between wallet.up_to_date and interface.is_up_to_date()
         # interface.is_up_to_date() returns true when all requests have been answered and processed
@@ -120,6 +199,9 @@ class Abstract_Wallet(PrintError):
         self.lock = threading.Lock()
         self.transaction_lock = threading.Lock()
 
+        self.history_index = HistoryIndex(self)
+        self.history_index.mark(self.tx_addr_hist.keys())
+
         self.check_history()
 
         # save wallet type the first time
@@ -137,44 +219,112 @@ class Abstract_Wallet(PrintError):
 
     @profiler
     def load_transactions(self):
-        self.txi = self.storage.get('txi', {})
-        self.txo = self.storage.get('txo', {})
-        self.tx_fees = self.storage.get('tx_fees', {})
-        self.pruned_txo = self.storage.get('pruned_txo', {})
-        tx_list = self.storage.get('transactions', {})
-        self.transactions = {}
-        for tx_hash, raw in tx_list.items():
-            tx = Transaction(raw)
-            self.transactions[tx_hash] = tx
-            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and (tx_hash not in self.pruned_txo.values()):
+        # the wallet shares these dicts with the storage, no copy is made
+        self.txi = self.storage.get_shared('txi', {})
+        self.txo = self.storage.get_shared('txo', {})
+        self.tx_fees = self.storage.get_shared('tx_fees', {})
+        self.pruned_txo = self.storage.get_shared('pruned_txo', {})
+        # transactions are parsed when they are first used
+        self.transactions = TransactionStore(self.storage.get_shared('transactions', {}))
+        self.build_txi_index()
+        for tx_hash in self.transactions.keys():
+            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and (tx_hash not in self.pruned_by_tx):
                 self.print_error("removing unreferenced tx", tx_hash)
                 self.transactions.pop(tx_hash)
+                self.changed_items.add(('transactions', tx_hash))
+
+    def build_txi_index(self):
+        # prevout tx hash -> set of txs whose txi spend its outputs
+        self.spending_txs = {}
+        for tx_hash, d in self.txi.items():
+            self.add_txi_index(tx_hash, d)
+        # tx hash -> set of its inputs that are in pruned_txo
+        self.pruned_by_tx = {}
+        for ser, tx_hash in self.pruned_txo.items():
+            self.pruned_by_tx.setdefault(tx_hash, set()).add(ser)
+
+    def add_txi_index(self, tx_hash, d):
+        for l in d.values():
+            for ser, v in l:
+                self.spending_txs.setdefault(ser.split(':')[0], set()).add(tx_hash)
+
+    def remove_txi_index(self, tx_hash, d):
+        for l in d.values():
+            for ser, v in l:
+                prevout_hash = ser.split(':')[0]
+                s = self.spending_txs.get(prevout_hash)
+                if s is not None:
+                    s.discard(tx_hash)
+                    if not s:
+                        self.spending_txs.pop(prevout_hash)
+
+    def add_pruned_txo(self, ser, tx_hash):
+        if ser in self.pruned_txo:
+            self.remove_pruned_txo(ser)
+        self.pruned_txo[ser] = tx_hash
+        self.pruned_by_tx.setdefault(tx_hash, set()).add(ser)
+        self.changed_items.add(('pruned_txo', ser))
+        self.history_index.mark([tx_hash])
+
+    def remove_pruned_txo(self, ser):
+        tx_hash = self.pruned_txo.pop(ser)
+        s = self.pruned_by_tx[tx_hash]
+        s.discard(ser)
+        if not s:
+            self.pruned_by_tx.pop(tx_hash)
+        self.changed_items.add(('pruned_txo', ser))
+        self.history_index.mark([tx_hash])
 
     @profiler
     def save_transactions(self, write=False):
+        if self.save_pending:
+            self.saves += 1
+        self.save_pending = False
+        self.last_save = time.time()
         with self.transaction_lock:
-            tx = {}
-            for k,v in self.transactions.items():
-                tx[k] = str(v)
-            self.storage.put('transactions', tx)
-            self.storage.put('txi', self.txi)
-            self.storage.put('txo', self.txo)
-            self.storage.put('tx_fees', self.tx_fees)
-            self.storage.put('pruned_txo', self.pruned_txo)
-            self.storage.put('addr_history', self.history)
+            while self.changed_items:
+                key, item_key = self.changed_items.pop()
+                self.storage.put_item(key, item_key, self.get_stored_item(key, item_key))
             if write:
                 self.storage.write()
 
+    def get_stored_item(self, key, item_key):
+        if key == 'transactions':
+            return self.transactions.get_raw(item_key)
+        d = {
+            'txi': self.txi,
+            'txo': self.txo,
+            'tx_fees': self.tx_fees,
+            'pruned_txo': self.pruned_txo,
+            'addr_history': self.history,
+        }[key]
+        return d.get(item_key)
+
+    def request_save(self):
+        self.save_requests += 1
+        self.save_pending = True
+
+    def save_pending_transactions(self):
+        '''Called from the network thread.  Requested saves are done at
+        most every SAVE_INTERVAL seconds.'''
+        if self.save_pending and time.time() - self.last_save >= SAVE_INTERVAL:
+            self.save_transactions()
+
     def clear_history(self):
         with self.transaction_lock:
             self.txi = {}
             self.txo = {}
             self.tx_fees = {}
             self.pruned_txo = {}
-        self.save_transactions()
+            self.build_txi_index()
+            self.changed_items.clear()
+            for key in ['txi', 'txo', 'tx_fees', 'pruned_txo', 'addr_history']:
+                self.storage.put(key, {})
         with self.lock:
             self.history = {}
             self.tx_addr_hist = {}
+        self.invalidate_addr_cache(self.addr_cache.keys())
+        self.history_index = HistoryIndex(self)
 
     @profiler
     def build_reverse_history(self):
@@ -188,19 +338,29 @@ class Abstract_Wallet(PrintError):
     @profiler
     def check_history(self):
         save = False
+        to_add = []
         for addr, hist in self.history.items():
             if not self.is_mine(addr):
                 self.history.pop(addr)
+                self.changed_items.add(('addr_history', addr))
+                self.invalidate_addr_cache([addr])
+                self.history_index.mark([tx_hash for tx_hash, height in hist])
                 save = True
                 continue
 
             for tx_hash, tx_height in hist:
-                if tx_hash in self.pruned_txo.values() or self.txi.get(tx_hash) or self.txo.get(tx_hash):
+                if tx_hash in self.pruned_by_tx or self.txi.get(tx_hash) or self.txo.get(tx_hash):
                     continue
-                tx = self.transactions.get(tx_hash)
-                if tx is not None:
-                    self.add_transaction(tx_hash, tx)
-                    save = True
+                if tx_hash in self.transactions:
+                    to_add.append(tx_hash)
+        # stored transactions missing from txi and txo, parsed in bulk
+        to_add = list(OrderedDict.fromkeys(to_add))
+        for tx_hash, tx in zip(to_add, self.transactions.get_many(to_add)):
+            if tx is None:
+                self.print_error("cannot parse stored transaction", tx_hash)
+                continue
+            self.add_transaction(tx_hash, tx)
+            save = True
         if save:
             self.save_transactions()
 
@@ -217,6 +377,15 @@ class Abstract_Wallet(PrintError):
         self.change_pubkeys = d.get('change', [])
         self.receiving_addresses = map(self.pubkeys_to_address, self.receiving_pubkeys)
         self.change_addresses = map(self.pubkeys_to_address, self.change_pubkeys)
+        self.build_address_index()
+
+    def build_address_index(self):
+        # address -> (is_change, index), kept in sync with the address lists
+        self.address_index = {}
+        for i, addr in enumerate(self.get_receiving_addresses()):
+            self.address_index[addr] = (False, i)
+        for i, addr in enumerate(self.get_change_addresses()):
+            self.address_index[addr] = (True, i)
 
     def synchronize(self):
         pass
@@ -226,6 +395,7 @@ class Abstract_Wallet(PrintError):
             self.up_to_date = up_to_date
         if up_to_date:
             self.save_transactions(write=True)
+            self.print_error("%d saves requested, %d done" % (self.save_requests, self.saves))
 
     def is_up_to_date(self):
         with self.lock: return self.up_to_date
@@ -249,22 +419,19 @@ class Abstract_Wallet(PrintError):
         return changed
 
     def is_mine(self, address):
-        return address in self.get_addresses()
+        return address in self.address_index
 
     def is_change(self, address):
-        if not self.is_mine(address):
-            return False
-        s = self.get_address_index(address)
+        s = self.address_index.get(address)
         if s is None:
             return False
         return s[0] == 1
 
     def get_address_index(self, address):
-        if address in self.receiving_addresses:
-            return False, self.receiving_addresses.index(address)
-        if address in self.change_addresses:
-            return True, self.change_addresses.index(address)
-        raise Exception("Address not found", address)
+        s = self.address_index.get(address)
+        if s is None:
+            raise Exception("Address not found", address)
+        return s
 
     def get_private_key(self, address, password):
         if self.is_watching_only():
@@ -280,13 +447,15 @@ class Abstract_Wallet(PrintError):
         # tx will be verified only if height > 0
         if tx_hash not in self.verified_tx:
             self.unverified_tx[tx_hash] = tx_height
+            self.history_index.mark([tx_hash])
 
     def add_verified_tx(self, tx_hash, info):
         # Remove from the unverified map and add to the verified map and
         self.unverified_tx.pop(tx_hash, None)
         with self.lock:
             self.verified_tx[tx_hash] = info  # (tx_height, timestamp, pos)
-        self.storage.put('verified_tx3', self.verified_tx)
+        self.storage.put_item('verified_tx3', tx_hash, info)
+        self.history_index.mark([tx_hash])
         height, conf, timestamp = self.get_tx_height(tx_hash)
         self.network.trigger_callback('verified', tx_hash, height, conf, timestamp)
 
@@ -298,11 +467,13 @@ class Abstract_Wallet(PrintError):
         '''Used by the verifier when a reorg has happened'''
         txs = []
         with self.lock:
-            for tx_hash, item in self.verified_tx:
+            for tx_hash, item in self.verified_tx.items():
                 tx_height, timestamp, pos = item
                 if tx_height >= height:
                     self.verified_tx.pop(tx_hash, None)
+                    self.storage.put_item('verified_tx3', tx_hash, None)
                     txs.append(tx_hash)
+        self.history_index.mark(txs)
         return txs
 
     def get_local_height(self):
@@ -343,7 +514,7 @@ class Abstract_Wallet(PrintError):
     def get_tx_delta(self, tx_hash, address):
         "effect of tx on address"
         # pruned
-        if tx_hash in self.pruned_txo.values():
+        if tx_hash in self.pruned_by_tx:
             return None
         delta = 0
         # substract the value of coins sent from address
@@ -358,7 +529,6 @@ class Abstract_Wallet(PrintError):
 
     def get_wallet_delta(self, tx):
         """ effect of tx on wallet """
-        addresses = self.get_addresses()
         is_relevant = False
         is_mine = False
         is_pruned = False
@@ -366,7 +536,7 @@ class Abstract_Wallet(PrintError):
         v_in = v_out = v_out_mine = 0
         for item in tx.inputs():
             addr = item.get('address')
-            if addr in addresses:
+            if self.is_mine(addr):
                 is_mine = True
                 is_relevant = True
                 d = self.txo.get(item['prevout_hash'], {}).get(addr, [])
@@ -386,7 +556,7 @@ class Abstract_Wallet(PrintError):
             is_partial = False
         for addr, value in tx.get_outputs():
             v_out += value
-            if addr in addresses:
+            if self.is_mine(addr):
                 v_out_mine += value
                 is_relevant = True
         if is_pruned:
@@ -418,7 +588,7 @@ class Abstract_Wallet(PrintError):
         height = conf = timestamp = None
         if tx.is_complete():
             tx_hash = tx.hash()
-            if tx_hash in self.transactions.keys():
+            if tx_hash in self.transactions:
                 label = self.get_label(tx_hash)
                 height, conf, timestamp = self.get_tx_height(tx_hash)
                 if height > 0:
@@ -471,36 +641,29 @@ class Abstract_Wallet(PrintError):
                 sent[txi] = height
         return received, sent
 
-    def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
-        out = []
-        for txo, v in coins.items():
-            tx_height, value, is_cb = v
-            prevout_hash, prevout_n = txo.split(':')
-            x = {
-                'address':address,
-                'value':value,
-                'prevout_n':int(prevout_n),
-                'prevout_hash':prevout_hash,
-                'height':tx_height,
-                'coinbase':is_cb
-            }
-            out.append(x)
-        return out
-
-    # return the total amount ever received by an address
-    def get_addr_received(self, address):
-        received, sent = self.get_addr_io(address)
-        return sum([v for height, v, is_cb in received.values()])
-
-    # return the balance of a bitcoin address: confirmed and matured, unconfirmed, unmatured
-    def get_addr_balance(self, address):
+    def invalidate_addr_cache(self, addresses):
+        self.addr_cache_gen += 1
+        for addr in addresses:
+            self.addr_cache.pop(addr, None)
+
+    def get_addr_cache(self, address):
+        '''Return (utxos, balance, received) of an address.  They are
+        computed once, and kept until the history, txi or txo of the
+        address change.  Coinbase maturity depends on the local height,
+        so addresses with coinbase outputs are also recomputed when it
+        changes.'''
+        local_height = self.get_local_height()
+        entry = self.addr_cache.get(address)
+        if entry is not None and entry[3] in [None, local_height]:
+            return entry
+        gen = self.addr_cache_gen
         received, sent = self.get_addr_io(address)
+        utxos = {}
         c = u = x = 0
+        has_coinbase = False
         for txo, (tx_height, v, is_cb) in received.items():
-            if is_cb and tx_height + COINBASE_MATURITY > self.get_local_height():
+            has_coinbase |= is_cb
+            if is_cb and tx_height + COINBASE_MATURITY > local_height:
                 x += v
             elif tx_height > 0:
                 c += v
@@ -511,7 +674,33 @@ class Abstract_Wallet(PrintError):
                     c -= v
                 else:
                     u -= v
-        return c, u, x
+            else:
+                prevout_hash, prevout_n = txo.split(':')
+                utxos[txo] = {
+                    'address':address,
+                    'value':v,
+                    'prevout_n':int(prevout_n),
+                    'prevout_hash':prevout_hash,
+                    'height':tx_height,
+                    'coinbase':is_cb
+                }
+        total = sum([v for height, v, is_cb in received.values()])
+        entry = utxos, (c, u, x), total, local_height if has_coinbase else None
+        # do not keep a result computed while the address was changing
+        if gen == self.addr_cache_gen:
+            self.addr_cache[address] = entry
+        return entry
+
+    def get_addr_utxo(self, address):
+        return [dict(x) for x in self.get_addr_cache(address)[0].values()]
+
+    # return the total amount ever received by an address
+    def get_addr_received(self, address):
+        return self.get_addr_cache(address)[2]
+
+    # return the balance of a bitcoin address: confirmed and matured, unconfirmed, unmatured
+    def get_addr_balance(self, address):
+        return self.get_addr_cache(address)[1]
 
     def get_spendable_coins(self, domain = None, exclude_frozen = True):
         coins = []
@@ -519,13 +708,12 @@ class Abstract_Wallet(PrintError):
             domain = self.get_addresses()
         if exclude_frozen:
             domain = set(domain) - self.frozen_addresses
+        local_height = self.get_local_height()
         for addr in domain:
-            utxos = self.get_addr_utxo(addr)
-            for x in utxos:
-                if x['coinbase'] and x['tx_height'] + COINBASE_MATURITY > self.get_local_height():
+            for x in self.get_addr_cache(addr)[0].values():
+                if x['coinbase'] and x['height'] + COINBASE_MATURITY > local_height:
                     continue
-                coins.append(x)
-                continue
+                coins.append(dict(x))
         return coins
 
     def dummy_address(self):
@@ -538,8 +726,7 @@ class Abstract_Wallet(PrintError):
                 self.add_input_info(i)
             _type, addr = recipient
             outputs = [(_type, addr, sendable)]
-            dummy_tx = Transaction.from_io(inputs, outputs)
-            fee = self.estimate_fee(config, dummy_tx.estimated_size())
+            fee = self.estimate_fee(config, Transaction.estimated_tx_size(inputs, outputs))
         amount = max(0, sendable - fee)
         return amount, fee
 
@@ -578,8 +765,12 @@ class Abstract_Wallet(PrintError):
     def add_transaction(self, tx_hash, tx):
         is_coinbase = tx.inputs()[0].get('is_coinbase') == True
         with self.transaction_lock:
+            # addresses whose txi or txo change
+            addrs = set(self.txi.get(tx_hash, {})) | set(self.txo.get(tx_hash, {}))
+            self.remove_txi_index(tx_hash, self.txi.get(tx_hash, {}))
             # add inputs
             self.txi[tx_hash] = d = {}
+            self.changed_items.add(('txi', tx_hash))
             for txi in tx.inputs():
                 addr = txi.get('address')
                 if not txi.get('is_coinbase'):
@@ -596,12 +787,15 @@ class Abstract_Wallet(PrintError):
                             if d.get(addr) is None:
                                 d[addr] = []
                             d[addr].append((ser, v))
+                            addrs.add(addr)
                             break
                     else:
-                        self.pruned_txo[ser] = tx_hash
+                        self.add_pruned_txo(ser, tx_hash)
+            self.add_txi_index(tx_hash, d)
 
             # add outputs
             self.txo[tx_hash] = d = {}
+            self.changed_items.add(('txo', tx_hash))
             for n, txo in enumerate(tx.outputs()):
                 ser = tx_hash + ':%d'%n
                 _type, x, v = txo
@@ -615,26 +809,33 @@ class Abstract_Wallet(PrintError):
                     if d.get(addr) is None:
                         d[addr] = []
                     d[addr].append((n, v, is_coinbase))
+                    addrs.add(addr)
                 # give v to txi that spends me
                 next_tx = self.pruned_txo.get(ser)
                 if next_tx is not None:
-                    self.pruned_txo.pop(ser)
+                    self.remove_pruned_txo(ser)
                     dd = self.txi.get(next_tx, {})
                     if dd.get(addr) is None:
                         dd[addr] = []
                     dd[addr].append((ser, v))
+                    self.spending_txs.setdefault(tx_hash, set()).add(next_tx)
+                    self.changed_items.add(('txi', next_tx))
+                    addrs.add(addr)
             # save
             self.transactions[tx_hash] = tx
+            self.changed_items.add(('transactions', tx_hash))
+            self.invalidate_addr_cache(addrs)
+            self.history_index.mark([tx_hash])
 
     def remove_transaction(self, tx_hash):
         with self.transaction_lock:
             self.print_error("removing tx from history", tx_hash)
             #tx = self.transactions.pop(tx_hash)
-            for ser, hh in self.pruned_txo.items():
-                if hh == tx_hash:
-                    self.pruned_txo.pop(ser)
+            for ser in list(self.pruned_by_tx.get(tx_hash, [])):
+                self.remove_pruned_txo(ser)
             # add tx to pruned_txo, and undo the txi addition
-            for next_tx, dd in self.txi.items():
+            for next_tx in self.spending_txs.pop(tx_hash, []):
+                dd = self.txi.get(next_tx, {})
                 for addr, l in dd.items():
                     ll = l[:]
                     for item in ll:
@@ -642,20 +843,27 @@ class Abstract_Wallet(PrintError):
                         prev_hash, prev_n = ser.split(':')
                         if prev_hash == tx_hash:
                             l.remove(item)
-                            self.pruned_txo[ser] = next_tx
+                            self.add_pruned_txo(ser, next_tx)
+                            self.changed_items.add(('txi', next_tx))
+                            self.invalidate_addr_cache([addr])
                     if l == []:
                         dd.pop(addr)
                     else:
                         dd[addr] = l
             try:
+                self.invalidate_addr_cache(self.txi.get(tx_hash, {}).keys() + self.txo.get(tx_hash, {}).keys())
+                self.remove_txi_index(tx_hash, self.txi.get(tx_hash, {}))
                 self.txi.pop(tx_hash)
                 self.txo.pop(tx_hash)
+                self.changed_items.add(('txi', tx_hash))
+                self.changed_items.add(('txo', tx_hash))
             except KeyError:
                 self.print_error("tx was not in history", tx_hash)
+            self.history_index.mark([tx_hash])
 
     def receive_tx_callback(self, tx_hash, tx, tx_height):
         self.add_transaction(tx_hash, tx)
-        self.save_transactions()
+        self.request_save()
         self.add_unverified_tx(tx_hash, tx_height)
 
     def receive_history_callback(self, addr, hist, tx_fees):
@@ -668,6 +876,9 @@ class Abstract_Wallet(PrintError):
                     if not self.tx_addr_hist[tx_hash]:
                         self.remove_transaction(tx_hash)
             self.history[addr] = hist
+            self.changed_items.add(('addr_history', addr))
+            self.invalidate_addr_cache([addr])
+            self.history_index.mark([tx_hash for tx_hash, height in old_hist + hist])
 
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
@@ -681,15 +892,42 @@ class Abstract_Wallet(PrintError):
             if tx is not None and self.txi.get(tx_hash, {}).get(addr) is None and self.txo.get(tx_hash, {}).get(addr) is None:
                 self.add_transaction(tx_hash, tx)
 
-        # Write updated TXI, TXO etc.
-        self.save_transactions()
         # Store fees
         self.tx_fees.update(tx_fees)
+        for tx_hash in tx_fees:
+            self.changed_items.add(('tx_fees', tx_hash))
+        # Write updated TXI, TXO etc.
+        self.request_save()
 
-    def get_history(self, domain=None):
-        # get domain
+    def get_wallet_tx_delta(self, tx_hash):
+        "effect of tx on the wallet, None if unknown, False if tx is not in history"
+        addrs = filter(self.is_mine, list(self.tx_addr_hist.get(tx_hash, [])))
+        if not addrs:
+            return False
+        delta = 0
+        for addr in addrs:
+            d = self.get_tx_delta(tx_hash, addr)
+            if d is None:
+                return None
+            delta += d
+        return delta
+
+    def get_history(self, domain=None, offset=0, limit=None):
+        """Return (tx_hash, height, conf, timestamp, delta, balance)
+        items, oldest first.  offset and limit select a page of the
+        history, counting from the newest transaction."""
         if domain is None:
-            domain = self.get_addresses()
+            c, u, x = self.get_balance()
+            rows = self.history_index.get_rows(c + u + x, offset, limit)
+            if rows is None:
+                self.print_error("Error: history not synchronized")
+                return []
+            h2 = []
+            for tx_hash, delta, balance in reversed(rows):
+                height, conf, timestamp = self.get_tx_height(tx_hash)
+                h2.append((tx_hash, height, conf, timestamp, delta, balance))
+            return h2
+
         # 1. Get the history of each address in the domain, maintain the
         #    delta of a tx as the sum of its deltas on domain addresses
         tx_deltas = defaultdict(int)
@@ -728,7 +966,8 @@ class Abstract_Wallet(PrintError):
             self.print_error("Error: history not synchronized")
             return []
 
-        return h2
+        stop = None if limit is None else offset + limit
+        return h2[::-1][offset:stop][::-1]
 
     def get_label(self, tx_hash):
         label = self.labels.get(tx_hash, '')
@@ -882,6 +1121,7 @@ class Abstract_Wallet(PrintError):
             if tx_hash not in vr:
                 self.print_error("removing transaction", tx_hash)
                 self.transactions.pop(tx_hash)
+                self.changed_items.add(('transactions', tx_hash))
 
     def start_threads(self, network):
         self.network = network
@@ -903,7 +1143,7 @@ class Abstract_Wallet(PrintError):
             # Now no references to the syncronizer or verifier
             # remain so they will be GC-ed
             self.storage.put('stored_height', self.get_local_height())
-        self.storage.write()
+        self.save_transactions(write=True)
 
     def wait_until_synchronized(self, callback=None):
         def wait_for_wallet():
@@ -1024,9 +1264,16 @@ class Abstract_Wallet(PrintError):
             tx.output_info.append((change, address_index))
 
         # sign
-        for keystore in self.get_keystores():
-            if not keystore.is_watching_only():
-                keystore.sign_transaction(tx, password)
+        with self.unlocked(password):
+            for keystore in self.get_keystores():
+                if not keystore.is_watching_only():
+                    keystore.sign_transaction(tx, password)
+
+    def unlocked(self, password):
+        '''Context manager keeping the decrypted keys of the software
+        keystores of the wallet in memory, so that the password is
+        checked and the keys are decrypted once for many signatures.'''
+        return UnlockedKeyStores(self.get_keystores(), password)
 
     def get_unused_addresses(self):
         # fixme: use slots from expired requests
@@ -1161,6 +1408,7 @@ class Abstract_Wallet(PrintError):
     def add_address(self, address):
         if address not in self.history:
             self.history[address] = []
+            self.changed_items.add(('addr_history', address))
         if self.synchronizer:
             self.synchronizer.add(address)
 
@@ -1178,6 +1426,7 @@ class Imported_Wallet(Abstract_Wallet):
 
     def load_addresses(self):
         self.addresses = self.storage.get('addresses', [])
+        self.build_address_index()
 
     def has_password(self):
         return False
@@ -1216,6 +1465,7 @@ class Imported_Wallet(Abstract_Wallet):
         if address in self.addresses:
             return
         self.addresses.append(address)
+        self.address_index[address] = (False, len(self.addresses) - 1)
         self.storage.put('addresses', self.addresses)
         self.storage.write()
         self.add_address(address)
@@ -1225,6 +1475,9 @@ class Imported_Wallet(Abstract_Wallet):
         if address not in self.addresses:
             return
         self.addresses.remove(address)
+        # indexes of the following addresses have shifted
+        self.build_address_index()
+        self.history_index.mark([tx_hash for tx_hash, height in self.history.get(address, [])])
         self.storage.put('addresses', self.addresses)
         self.storage.write()
 
@@ -1314,6 +1567,7 @@ class Deterministic_Wallet(Abstract_Wallet):
             n = len(addresses) - k + value
             self.receiving_pubkeys = self.receiving_pubkeys[0:n]
             self.receiving_addresses = self.receiving_addresses[0:n]
+            self.build_address_index()
             self.gap_limit = value
             self.storage.put('gap_limit', self.gap_limit)
             self.save_pubkeys()
@@ -1342,29 +1596,36 @@ class Deterministic_Wallet(Abstract_Wallet):
                 if n > nmax: nmax = n
         return nmax + 1
 
-    def create_new_address(self, for_change):
+    def create_new_addresses(self, for_change, count):
         pubkey_list = self.change_pubkeys if for_change else self.receiving_pubkeys
-        n = len(pubkey_list)
-        x = self.new_pubkeys(for_change, n)
-        pubkey_list.append(x)
-        self.save_pubkeys()
-        address = self.pubkeys_to_address(x)
         addr_list = self.change_addresses if for_change else self.receiving_addresses
-        addr_list.append(address)
-        self.add_address(address)
-        return address
+        addresses = []
+        for x in self.new_pubkeys(for_change, len(pubkey_list), count):
+            pubkey_list.append(x)
+            address = self.pubkeys_to_address(x)
+            addr_list.append(address)
+            self.address_index[address] = (for_change, len(addr_list) - 1)
+            addresses.append(address)
+        self.save_pubkeys()
+        for address in addresses:
+            self.add_address(address)
+        return addresses
+
+    def create_new_address(self, for_change):
+        return self.create_new_addresses(for_change, 1)[0]
 
     def synchronize_sequence(self, for_change):
         limit = self.gap_limit_for_change if for_change else self.gap_limit
-        while True:
-            addresses = self.get_change_addresses() if for_change else self.get_receiving_addresses()
-            if len(addresses) < limit:
-                self.create_new_address(for_change)
-                continue
-            if map(lambda a: self.address_is_old(a), addresses[-limit:] ) == limit*[False]:
+        addresses = self.get_change_addresses() if for_change else self.get_receiving_addresses()
+        # the last limit addresses must not be old; new addresses are
+        # created in one batch
+        k = 0
+        for a in addresses[::-1]:
+            if k == limit or self.address_is_old(a):
                 break
-            else:
-                self.create_new_address(for_change)
+            k += 1
+        if k < limit:
+            self.create_new_addresses(for_change, limit - k)
 
     def synchronize(self):
         with self.lock:
@@ -1376,12 +1637,13 @@ class Deterministic_Wallet(Abstract_Wallet):
                     self.receiving_pubkeys = self.keystore.keypairs.keys()
                     self.save_pubkeys()
                     self.receiving_addresses = map(self.pubkeys_to_address, self.receiving_pubkeys)
+                    self.build_address_index()
                     for addr in self.receiving_addresses:
                         self.add_address(addr)
 
     def is_beyond_limit(self, address, is_change):
         addr_list = self.get_change_addresses() if is_change else self.get_receiving_addresses()
-        i = addr_list.index(address)
+        i = self.get_address_index(address)[1]
         prev_addresses = addr_list[:max(0, i)]
         limit = self.gap_limit_for_change if is_change else self.gap_limit
         if len(prev_addresses) < limit:
@@ -1411,8 +1673,8 @@ class Standard_Wallet(Deterministic_Wallet, P2PK_Wallet):
     def get_master_public_key(self):
         return self.keystore.get_master_public_key()
 
-    def new_pubkeys(self, c, i):
-        return self.keystore.derive_pubkey(c, i)
+    def new_pubkeys(self, c, start, count):
+        return self.keystore.derive_pubkeys(c, start, count)
 
     def get_keystore(self):
         return self.keystore
@@ -1446,6 +1708,7 @@ class Standard_Wallet(Deterministic_Wallet, P2PK_Wallet):
         self.save_pubkeys()
         addr = self.pubkeys_to_address(pubkey)
         self.receiving_addresses.append(addr)
+        self.address_index[addr] = (False, len(self.receiving_addresses) - 1)
         self.add_address(addr)
         return addr
 
@@ -1473,8 +1736,8 @@ class Multisig_Wallet(Deterministic_Wallet):
         address = hash_160_to_bc_address(hash_160(redeem_script.decode('hex')), 5)
         return address
 
-    def new_pubkeys(self, c, i):
-        return [k.derive_pubkey(c, i) for k in self.keystores.values()]
+    def new_pubkeys(self, c, start, count):
+        return map(list, zip(*[k.derive_pubkeys(c, start, count) for k in self.keystores.values()]))
 
     def load_keystore(self):
         self.keystores = {}